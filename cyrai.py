@@ -3,10 +3,12 @@ import asyncio
 import time
 import os
 import requests
-import websocket
-from flask import Flask, request, render_template_string, redirect, url_for, session, flash, jsonify
+import aiohttp
+from flask import Flask, request, render_template_string, redirect, url_for, session, flash, jsonify, Response
 from twitchio.ext import commands
+import twitchio.websocket
 import re
+import textwrap
 import hashlib
 import secrets
 import uuid
@@ -14,6 +16,25 @@ import functools
 import json
 import random
 import urllib.parse
+import collections
+import sys
+import sqlite3
+import atexit
+import bisect
+import math
+import contextlib
+import contextvars
+import logging
+import logging.handlers
+import queue
+import zlib
+
+from percentiles import percentile
+
+try:
+    import tiktoken  # Optional: exact BPE token counts for context budgeting
+except ImportError:
+    tiktoken = None
 
 # ---------------------
 # Configuration Section
@@ -23,6 +44,13 @@ import urllib.parse
 TWITCH_USERNAME = ""
 TWITCH_OAUTH_TOKEN = ""
 STREAMER_CHANNEL = ""
+EXTRA_CHANNELS = []  # More channels the bot serves besides STREAMER_CHANNEL, e.g. ["partnerstreamer"]
+CHANNEL_SETTINGS_DIR = "channels"  # Optional channels/<name>/whitelist.txt and system_prompt.txt per channel
+CHAT_SHARDS = 1  # Chat connections the channels are spread over
+CHANNEL_SHARD_OVERRIDES = {}  # Channel -> shard index, e.g. {"bigstreamer": 1} to isolate a hot channel
+TWITCH_IRC_WS_URL = "wss://irc-ws.chat.twitch.tv:443"  # Chat endpoint, e.g. "ws://127.0.0.1:6680" for irc_simulator.py
+BOT_ALIASES = []  # Other names the bot answers to besides TWITCH_USERNAME, e.g. ["adam"]
+MENTION_TAGS = {"(global)": "global"}  # Tags stripped from a mention's prompt -> flag they set
 
 # Twitch OAuth Configuration (for web authentication)
 TWITCH_CLIENT_ID = ""  # Replace with your Twitch application client ID
@@ -35,20 +63,112 @@ BOT_OWNERS = [""]  # Users with full access
 
 # LM Studio API configuration
 LM_STUDIO_API_URL = "http://localhost:1234/v1/chat/completions"
+LM_STUDIO_API_URLS = [LM_STUDIO_API_URL]  # Every OpenAI-compatible endpoint requests are spread over
 LM_STUDIO_MODEL = "gemma-2-9b-it"
 DEFAULT_TEMPERATURE = 0.6
-DEFAULT_MAX_TOKENS = 100
+DEFAULT_MAX_TOKENS = 100  # Completion length when nothing more specific applies, chat replies use reply_budget()
 DEFAULT_NUM_CTX = 4096
+LM_STUDIO_STREAM = True  # Stream completions and send the reply sentence by sentence as it is generated
+CHAT_MESSAGE_MAX_CHARS = 500  # Twitch's limit per chat message, longer replies are split
+REPLY_MAX_MESSAGES = 1  # Chat messages one reply may fill, generation stops once they're full
+REPLY_CHARS_PER_TOKEN = 3  # Low estimate of characters per generated token, for turning that allowance into max_tokens
+CHAT_RATE_LIMIT = 20  # Messages the bot may send per CHAT_RATE_PERIOD, counting every channel it isn't a moderator in
+CHAT_MOD_RATE_LIMIT = 100  # Messages per CHAT_RATE_PERIOD in total, when sending where it's a moderator or broadcaster
+CHAT_RATE_PERIOD = 30  # Seconds
+CHAT_REPLY_DEADLINE = 60  # Seconds after a mention its reply is still worth sending, queued replies older than this are dropped
+CHAT_DUPLICATE_SUFFIX = " \U000E0000"  # Invisible tag added when a message repeats the previous one, which Twitch drops
+CHAT_SEND_MAX_ATTEMPTS = 3  # Tries per chat message before it's given up on, waiting for a reconnect doesn't count
+CHAT_CHECK_INTERVAL = 5  # Seconds between checks that each chat connection is still up
+CHAT_PING_INTERVAL = 60  # Seconds between the keep-alive PINGs the bot sends on each chat connection
+CHAT_PONG_TIMEOUT = 10  # Seconds to wait for Twitch's PONG before the connection is considered dead and reopened
+CHAT_RECONNECT_BASE_DELAY = 1  # Seconds before reconnecting after a lost connection or crash, doubled for every further one
+CHAT_RECONNECT_MAX_DELAY = 120  # Upper bound of that delay
+CHAT_RESTART_RESET_AFTER = 300  # Seconds the bot must have run for the next crash to start over at the base delay
+STREAM_MIN_CHUNK_CHARS = 40  # Short sentences are merged with the next one so chat isn't spammed with fragments
+LM_STUDIO_MAX_CONNECTIONS = 8  # Size of the keep-alive connection pool to LM Studio
+LM_STUDIO_KEEPALIVE_TIMEOUT = 60  # Seconds an idle pooled connection is kept open
+LM_STUDIO_CONNECT_TIMEOUT = 5  # Seconds to establish a new connection
+LM_STUDIO_READ_TIMEOUT = 30  # Seconds to wait for the next bytes of a response
+LM_STUDIO_REQUEST_TIMEOUT = 30  # Overall deadline for a non-streamed completion
+LLM_MAX_CONCURRENCY = 2  # Generations allowed to run against LM Studio at the same time
+LLM_MAX_QUEUE = 50  # Mentions allowed to wait for a free slot before new ones are dropped
+LLM_MAX_QUEUE_PER_USER = 3  # Waiting mentions allowed per chatter
+LLM_MAX_BACKGROUND_QUEUE = 20  # Low-priority jobs (conversation summaries) allowed to wait
+LLM_BATCHING_ENABLED = False  # Collect bursts of mentions and release them to the backends together
+LLM_BATCH_WINDOW_MS = 100  # How long the first request of a batch waits for company
+LLM_BATCH_MAX_SIZE = 8  # Requests released per batch, capped by LLM_MAX_CONCURRENCY: raise that too or batches stay tiny
+LLM_BALANCING = "least_outstanding"  # Backend selection: "least_outstanding" or "latency" (first-token EWMA)
+LLM_LATENCY_EWMA_ALPHA = 0.2  # Weight of the newest sample in a backend's time-to-first-token average
+LLM_CIRCUIT_FAILURE_THRESHOLD = 3  # Consecutive failures that open a backend's circuit
+LLM_CIRCUIT_OPEN_DURATION = 30  # Seconds an open circuit fails fast before a half-open trial request
+LLM_HEALTH_CHECK_INTERVAL = 15  # Seconds between active probes of every backend
+LLM_HEALTH_CHECK_TIMEOUT = 3
+LLM_HEDGING_ENABLED = False  # Race a second backend when the first is slow to produce its first token
+LLM_HEDGE_MIN_DELAY = 0.5  # Never hedge sooner than this many seconds
+LLM_HEDGE_DEFAULT_DELAY = 3.0  # Hedge delay used until enough first-token samples exist for a p95
+LLM_HEDGE_MIN_SAMPLES = 20
+RESPONSE_CACHE_ENABLED = True  # Reuse replies for identical prompts with identical context
+RESPONSE_CACHE_TTL = 10 * 60  # Seconds a cached reply stays valid
+RESPONSE_CACHE_MAX_ENTRIES = 1000
+RESPONSE_CACHE_MAX_CHARS = 500_000  # Upper bound on the text held by the cache (keys + replies)
+COALESCE_GLOBAL_PROMPTS = True  # Identical (global) prompts asked while one is generating share its reply
+CONTEXT_TOKENIZER = "auto"  # "tiktoken", "heuristic", or "auto" (tiktoken when installed)
+CONTEXT_MESSAGE_OVERHEAD_TOKENS = 4  # Chat-template tokens wrapped around every message
+CONTEXT_SAFETY_TOKENS = 64  # Headroom kept free for tokenizer mismatch with the real model
+TOKEN_COUNT_CACHE_SIZE = 8192  # Messages whose token counts are memoized
+CONVERSATION_COMPACTION_ENABLED = False  # Fold trimmed turns into a rolling summary instead of forgetting them
+SUMMARY_MAX_TOKENS = 120  # Length cap for the rolling summary
+SUMMARY_TEMPERATURE = 0.2
+SUMMARY_SYSTEM_PROMPT = (
+    "You keep a running summary of a Twitch chat conversation with an AI chat bot. "
+    "Merge the previous summary and the new turns into at most three short sentences. "
+    "Keep names, facts, preferences and running jokes worth remembering and drop greetings and filler. "
+    "Reply with the summary only."
+)
+SUMMARY_LABEL = "Summary of the earlier conversation: "  # Prefix of the summary message sent to the model
+# Set PROMPT_PREFIX_CACHE_MODE = True to trim history in big blocks (PREFIX_EVICT_BLOCK_FRACTION) so the prompt
+# prefix, and with it the backend's KV cache, stays stable between requests. It pays off when the backend reuses
+# cached prefixes (llama.cpp/LM Studio with LM_STUDIO_CACHE_HINTS); the cost is forgetting a block of history at once.
+PROMPT_PREFIX_CACHE_MODE = False
+PREFIX_EVICT_BLOCK_FRACTION = 0.25  # Share of the history budget freed at once when trimming in prefix-cache mode
+LM_STUDIO_CACHE_HINTS = True  # Send llama.cpp's cache_prompt hint so the server reuses the cached prefix
+PREFIX_CACHE_SLOTS = 4  # Recent prompts remembered when estimating prefix reuse (roughly the backend's slot count)
 
 # Files for persistent data
 SYSTEM_PROMPT_FILE = "system_prompt.txt"
 DEFAULT_SYSTEM_PROMPT_FILE = "default_system_prompt.txt"  # File containing the default system prompt
 WHITELIST_FILE = "whitelist.txt"
 MODERATORS_FILE = "moderators.txt"  # New file to store moderators
+CONVERSATION_DB_FILE = "conversations.db"  # SQLite database the conversation contexts are persisted to
 
 # In-memory conversation contexts
-user_conversations = {}  # Dictionary to store individual user conversations
-global_conversation = []  # Shared context used when tagged with (global)
+user_conversations = None  # ConversationManager of user id -> ConversationBuffer, created below
+global_conversation = None  # Shared ConversationBuffer used when tagged with (global), created below
+CONVERSATION_MAX_USERS = 5000  # Least recently used user contexts are dropped beyond this
+CONVERSATION_IDLE_TTL = 2 * 60 * 60  # Seconds a user context may sit untouched before it's dropped
+CONVERSATION_STORE_ENABLED = True  # Keep contexts across restarts in CONVERSATION_DB_FILE
+CONVERSATION_FLUSH_INTERVAL = 2  # Seconds between background writes of changed contexts
+CONVERSATION_RETENTION_DAYS = 30  # Stored contexts untouched for longer than this are deleted
+GLOBAL_CONVERSATION_KEY = "(global)"  # Store key of the shared context (can't clash with a Twitch login)
+
+# Metrics configuration
+METRICS_ENABLED = True  # Serve Prometheus metrics on /metrics (no login, so scrapers can reach it)
+# /metrics shows backend URLs and channel names; set either of these to restrict it, both off by default
+METRICS_BEARER_TOKEN = None  # Require "Authorization: Bearer <token>", e.g. bearer_token in the Prometheus scrape config
+METRICS_ALLOWED_IPS = ()  # Only answer scrapes from these addresses, e.g. ("127.0.0.1", "10.0.0.5")
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # Histogram buckets in seconds
+TRACING_ENABLED = True  # Time every mention stage by stage for the /traces page
+TRACE_BUFFER_SIZE = 500  # Most recent mention traces kept in memory
+TRACES_SHOWN = 25  # Slowest traces listed on the /traces page
+
+# Logging configuration
+LOG_LEVEL = "INFO"  # DEBUG also shows every LLM request and context update
+LOG_LEVELS = {}  # Per-category overrides, e.g. {"cyrai.llm": "DEBUG", "cyrai.web": "WARNING"}
+LOG_FILE = "cyrai.log"  # Rotated log file, None to only log to the console
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024  # Size at which the log file is rotated
+LOG_FILE_BACKUPS = 5  # Rotated log files kept
+LOG_JSON = False  # Write the log file as JSON lines instead of plain text
+LOG_SAMPLE_RATES = {"cyrai.chat.received": 100}  # Keep 1 in N records of a category, warnings and errors always pass
 
 # Security configuration
 SECRET_KEY = secrets.token_hex(32)  # Generate a secure random key for session encryption
@@ -59,6 +179,105 @@ PASSWORD_HASHES = {
 }
 SESSION_TIMEOUT = 30 * 60  # 30 minutes
 
+# ---------------------------
+# Logging
+# ---------------------------
+chat_log = logging.getLogger("cyrai.chat")
+received_log = logging.getLogger("cyrai.chat.received")  # Chat messages that don't mention the bot, sampled
+llm_log = logging.getLogger("cyrai.llm")
+send_log = logging.getLogger("cyrai.send")
+store_log = logging.getLogger("cyrai.store")
+bot_log = logging.getLogger("cyrai.bot")
+web_log = logging.getLogger("cyrai.web")
+
+# The mention being handled; asyncio tasks inherit it, so logging and tracing can tag
+# their records without it being passed around
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class SamplingFilter(logging.Filter):
+    """Lets through 1 in N records of the categories in rates, warnings and errors always pass"""
+    
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self._seen = collections.Counter()
+    
+    def filter(self, record):
+        rate = self.rates.get(record.name)
+        if not rate or rate <= 1 or record.levelno >= logging.WARNING:
+            return True
+        seen = self._seen[record.name]
+        self._seen[record.name] = seen + 1
+        return seen % rate == 0
+
+class TraceIdFilter(logging.Filter):
+    """Tags records with the trace ID of the mention being handled, "-" outside of one"""
+    
+    def filter(self, record):
+        trace = current_trace.get()
+        record.trace_id = trace.trace_id if trace else "-"
+        return True
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # The stock handler formats the message here, on the caller's thread; the listener
+        # can do it just as well since everything stays in this process
+        return record
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "category": record.name,
+            "trace_id": getattr(record, "trace_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+log_listener = None
+
+def setup_logging(log_file=LOG_FILE):
+    """Send every cyrai.* record through a queue to a background thread that does the I/O.
+    
+    Logging on the event loop is then a filter check and a queue put; formatting and
+    writing to the console and the rotated log file happen on the listener's thread.
+    """
+    global log_listener
+    if log_listener:
+        return
+    logger = logging.getLogger("cyrai")
+    logger.setLevel(LOG_LEVEL)
+    for category, level in LOG_LEVELS.items():
+        logging.getLogger(category).setLevel(level)
+    
+    text_format = logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(trace_id)s] %(message)s")
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(text_format)
+    handlers = [console]
+    if log_file:
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS, encoding="utf-8"
+        )
+        file_handler.setFormatter(JsonFormatter() if LOG_JSON else text_format)
+        handlers.append(file_handler)
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_RATES))
+    queue_handler.addFilter(TraceIdFilter())
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+    log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+if __name__ == "__main__":
+    # Only when run as the bot, tools importing this module keep their own logging setup
+    setup_logging()
+
 # Load system prompt from file or use default
 if os.path.exists(SYSTEM_PROMPT_FILE):
     with open(SYSTEM_PROMPT_FILE, "r", encoding="utf-8") as f:
@@ -66,321 +285,2682 @@ if os.path.exists(SYSTEM_PROMPT_FILE):
 else:
     system_prompt = "You are a helpful assistant."
 
-# Create default system prompt file if it doesn't exist
-if not os.path.exists(DEFAULT_SYSTEM_PROMPT_FILE):
-    try:
-        print(f"Creating default system prompt file at {DEFAULT_SYSTEM_PROMPT_FILE}")
-        with open(DEFAULT_SYSTEM_PROMPT_FILE, "w", encoding="utf-8") as f:
-            # Save the current system prompt as the default if it exists
-            if os.path.exists(SYSTEM_PROMPT_FILE):
-                with open(SYSTEM_PROMPT_FILE, "r", encoding="utf-8") as sf:
-                    default_content = sf.read() or "You are a helpful assistant."
-                f.write(default_content)
-            else:
-                f.write("You are a helpful assistant.")
-        print("Default system prompt file created successfully")
-    except Exception as e:
-        print(f"Error creating default system prompt file: {e}")
+# Create default system prompt file if it doesn't exist
+if not os.path.exists(DEFAULT_SYSTEM_PROMPT_FILE):
+    try:
+        bot_log.info("Creating default system prompt file at %s", DEFAULT_SYSTEM_PROMPT_FILE)
+        with open(DEFAULT_SYSTEM_PROMPT_FILE, "w", encoding="utf-8") as f:
+            # Save the current system prompt as the default if it exists
+            if os.path.exists(SYSTEM_PROMPT_FILE):
+                with open(SYSTEM_PROMPT_FILE, "r", encoding="utf-8") as sf:
+                    default_content = sf.read() or "You are a helpful assistant."
+                f.write(default_content)
+            else:
+                f.write("You are a helpful assistant.")
+        bot_log.info("Default system prompt file created successfully")
+    except Exception as e:
+        bot_log.error("Error creating default system prompt file: %s", e)
+
+# Hardcoded safety rule that cannot be edited from the portal
+SAFETY_RULE = "No racism, sexism, or any discriminatory garbage. "
+
+# Combine the safety rule with the user-editable part of the prompt
+system_prompt = SAFETY_RULE + system_prompt
+
+# Global variables
+whitelist = set()
+should_restart = False  # Flag to indicate if the bot should restart
+twitch_bot = None  # The running TwitchBot (first shard), so the web app can read its stats
+twitch_bots = []  # Every running shard, the LLM pipeline is shared between them
+
+# Functions for persistent whitelist
+def load_whitelist():
+    global whitelist
+    if os.path.exists(WHITELIST_FILE):
+        with open(WHITELIST_FILE, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+        whitelist = set(line.strip().lower() for line in lines if line.strip())
+    return whitelist
+
+def save_whitelist():
+    with open(WHITELIST_FILE, "w", encoding="utf-8") as f:
+        for user in sorted(whitelist):
+            f.write(f"{user}\n")
+    web_log.info("Whitelist saved with %d users.", len(whitelist))
+
+# Load the whitelist at startup
+load_whitelist()
+
+# Global whitelist for allowed Twitch users (stored as lower-case)
+whitelist = load_whitelist()
+
+# Functions for moderator management
+def load_moderators():
+    moderators = []
+    if os.path.exists(MODERATORS_FILE):
+        with open(MODERATORS_FILE, "r", encoding="utf-8") as f:
+            moderators = [line.strip().lower() for line in f if line.strip()]
+    return moderators
+
+def save_moderators(moderators):
+    with open(MODERATORS_FILE, "w", encoding="utf-8") as f:
+        for user in moderators:
+            f.write(f"{user}\n")
+    web_log.info("Moderators list saved with %d users.", len(moderators))
+
+# Load moderators from file on startup
+moderators = load_moderators()
+
+# Create an empty set for active sessions, to track who's logged in
+active_sessions = {}
+
+# ---------------------------
+# Metrics
+# ---------------------------
+class Metric:
+    """Base for the Prometheus metric types below.
+    
+    Recording is a dict lookup plus an addition under a lock, cheap enough to leave on
+    in production; the text exposition is only built when /metrics is scraped.
+    """
+    kind = None
+    
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+    
+    @staticmethod
+    def _format_labels(names, values):
+        if not names:
+            return ""
+        pairs = ",".join(
+            '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for name, value in zip(names, values)
+        )
+        return "{" + pairs + "}"
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+    
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {} if labelnames else {(): 0}
+    
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+    
+    def _samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{self._format_labels(self.labelnames, labels)} {value}" for labels, value in values]
+
+class Gauge(Metric):
+    """A value read when scraped, from a function returning a number or {labels: number}"""
+    kind = "gauge"
+    
+    def __init__(self, name, documentation, function, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+    
+    def _samples(self):
+        try:
+            value = self.function()
+        except Exception as e:
+            web_log.warning("Error reading metric %s: %s", self.name, e)
+            return []
+        if value is None:
+            return []
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [f"{self.name}{self._format_labels(self.labelnames, labels)} {v}" for labels, v in value.items()]
+
+class Histogram(Metric):
+    kind = "histogram"
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [bucket counts..., +Inf count, sum]
+        if not labelnames:
+            self._series[()] = [0] * (len(self.buckets) + 2)
+    
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+    
+    def _samples(self):
+        with self._lock:
+            series = [(labels, list(values)) for labels, values in self._series.items()]
+        lines = []
+        names = self.labelnames + ("le",)
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self._format_labels(names, labels + (bound,))} {cumulative}")
+            plain = self._format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{plain} {values[-1]}")
+            lines.append(f"{self.name}_count{plain} {cumulative}")
+        return lines
+
+metrics_registry = []
+
+def render_metrics():
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+MESSAGES_RECEIVED = Counter("cyrai_messages_received_total", "Chat messages seen by the bot", ("channel",))
+MENTIONS = Counter("cyrai_mentions_total", "Mentions of the bot by whitelisted users", ("channel", "context"))
+WHITELIST_REJECTS = Counter("cyrai_whitelist_rejects_total", "Mentions ignored because the user isn't whitelisted")
+MENTION_REPLY_SECONDS = Histogram("cyrai_mention_reply_seconds", "Time from receiving a mention until its reply was sent",
+                                  ("channel",))
+LLM_QUEUE_WAIT_SECONDS = Histogram("cyrai_llm_queue_wait_seconds", "Time requests waited for a scheduler slot", ("lane",))
+LLM_REQUEST_SECONDS = Histogram("cyrai_llm_request_seconds", "LM Studio request duration, retries included", ("mode", "outcome"))
+LLM_FIRST_TOKEN_SECONDS = Histogram("cyrai_llm_first_token_seconds", "Time until a streamed request produced its first token")
+LLM_EARLY_STOPS = Counter("cyrai_llm_early_stops_total", "Streams stopped because the reply filled its chat allowance")
+LLM_TOKENS_GENERATED = Counter("cyrai_llm_tokens_generated_total", "Completion tokens received from LM Studio")
+MESSAGES_SENT = Counter("cyrai_chat_messages_sent_total", "Messages sent to Twitch chat")
+SEND_RETRIES = Counter("cyrai_send_retries_total", "Failed attempts to send a chat message that were retried")
+SEND_FAILURES = Counter("cyrai_send_failures_total", "Chat messages given up on after all retries")
+CHAT_SEND_LAG_SECONDS = Histogram("cyrai_chat_send_lag_seconds", "Time messages waited in the outbound queue", ("lane",))
+CHAT_SEND_DROPPED = Counter("cyrai_chat_send_dropped_total", "Queued messages given up on", ("reason",))
+CHAT_SEND_MERGED = Counter("cyrai_chat_send_merged_total", "Queued messages merged into another one to save rate limit")
+WEBSOCKET_RECONNECTS = Counter("cyrai_websocket_reconnects_total", "Reconnects of a Twitch chat connection", ("reason",))
+CHAT_PING_RTT_SECONDS = Histogram("cyrai_chat_ping_rtt_seconds", "Round trip of the keep-alive PING to Twitch chat", ("shard",))
+
+def scheduler_stat(key):
+    return twitch_bot.llm_scheduler.stats()[key] if twitch_bot else None
+
+Gauge("cyrai_conversations", "Conversation contexts held in memory, the global ones included",
+      lambda: sum(1 for _ in all_conversations()))
+Gauge("cyrai_history_messages", "Messages across all in-memory conversation contexts",
+      lambda: sum(len(conversation) for conversation in all_conversations()))
+Gauge("cyrai_history_tokens", "Estimated tokens across all in-memory conversation contexts",
+      lambda: sum(conversation.token_count for conversation in all_conversations()))
+Gauge("cyrai_llm_queue_depth", "Chat requests waiting for a scheduler slot", lambda: scheduler_stat("queue_depth"))
+Gauge("cyrai_llm_running", "LLM generations in progress", lambda: scheduler_stat("running"))
+Gauge("cyrai_llm_backend_up", "1 while a backend's circuit is closed, 0 while it's open or half-open",
+      lambda: {(backend.url,): int(backend.state == "closed") for backend in twitch_bot.llm_client.backends.backends}
+      if twitch_bot else None, ("backend",))
+Gauge("cyrai_chat_send_queue_depth", "Chat messages waiting in the outbound queue",
+      lambda: {(lane,): depth for lane, depth in twitch_bot.outbound.depths().items()} if twitch_bot else None, ("lane",))
+Gauge("cyrai_chat_connected", "1 while a shard's chat connection is up",
+      lambda: {(str(bot.shard),): int(bot.chat_ready()) for bot in twitch_bots}, ("shard",))
+Gauge("cyrai_channel_in_flight", "Mentions of a channel being answered right now",
+      lambda: {(channel.name,): channel.in_flight for channel in list(channel_contexts.values())}, ("channel",))
+
+# ---------------------------
+# Mention tracing
+# ---------------------------
+class Trace:
+    """Timeline of one mention, from receiving it to the last reply chunk being sent.
+    
+    Spans are (name, offset, duration, details) with times relative to the start of the
+    trace. Streamed replies overlap: chunks are sent while generation continues.
+    """
+    __slots__ = ("trace_id", "user", "context", "channel", "started", "wall_started", "spans", "duration", "outcome")
+    
+    def __init__(self, user, context, channel=None):
+        self.trace_id = uuid.uuid4().hex[:12]
+        self.user = user
+        self.context = context
+        self.channel = channel
+        self.started = time.perf_counter()
+        self.wall_started = time.time()
+        self.spans = []
+        self.duration = None
+        self.outcome = "ok"
+    
+    def add_span(self, name, started, ended=None, **details):
+        ended = time.perf_counter() if ended is None else ended
+        self.spans.append((name, started - self.started, ended - started, details))
+    
+    @contextlib.contextmanager
+    def span(self, name, **details):
+        started = time.perf_counter()
+        try:
+            yield details
+        finally:
+            self.add_span(name, started, **details)
+    
+    def finish(self, outcome=None):
+        if outcome:
+            self.outcome = outcome
+        self.duration = time.perf_counter() - self.started
+        self.spans.sort(key=lambda span: span[1])
+        trace_buffer.add(self)
+    
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "user": self.user,
+            "context": self.context,
+            "channel": self.channel,
+            "started": self.wall_started,
+            "duration": self.duration,
+            "outcome": self.outcome,
+            "spans": [
+                {"name": name, "offset": offset, "duration": duration, **details}
+                for name, offset, duration, details in self.spans
+            ],
+        }
+
+class TraceBuffer:
+    """Ring buffer of finished traces; the web app reads it from another thread"""
+    
+    def __init__(self, size=TRACE_BUFFER_SIZE):
+        self._traces = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+    
+    def add(self, trace):
+        with self._lock:
+            self._traces.append(trace)
+    
+    def slowest(self, count):
+        with self._lock:
+            traces = list(self._traces)
+        return sorted(traces, key=lambda trace: trace.duration, reverse=True)[:count]
+    
+    def __len__(self):
+        return len(self._traces)
+
+trace_buffer = TraceBuffer()
+
+def trace_span(name, **details):
+    trace = current_trace.get()
+    return trace.span(name, **details) if trace else contextlib.nullcontext(details)
+
+# ---------------------------
+# Mention scanning
+# ---------------------------
+Mention = collections.namedtuple("Mention", ["prompt", "flags"])
+
+class MentionScanner:
+    """Finds mentions of the bot and strips its names and tags from the prompt.
+    
+    Built once per bot with everything compiled up front. Non-mentions, nearly all of
+    chat, cost one lower() and a substring check per name; for mentions a single regex
+    pass removes every name and tag and records which tags were present.
+    """
+    
+    def __init__(self, names, tags=MENTION_TAGS):
+        # Longest first so a name that contains another one is removed whole
+        self.names = tuple(sorted({name.lower() for name in names if name}, key=len, reverse=True))
+        self.tags = {tag.lower(): flag for tag, flag in tags.items()}
+        alternatives = []
+        if self.names:
+            alternatives.append(r"@?\b(?:{})\b".format("|".join(map(re.escape, self.names))))
+        if self.tags:
+            alternatives.append(r"(?P<tag>{})".format("|".join(map(re.escape, self.tags))))
+        self._pattern = re.compile("|".join(alternatives), re.IGNORECASE) if alternatives else None
+    
+    def scan(self, content):
+        """Return a Mention(prompt, flags) if the message mentions the bot, otherwise None"""
+        lowered = content.lower()
+        for name in self.names:
+            if name in lowered:
+                break
+        else:
+            return None
+        
+        flags = set()
+        
+        def strip(match):
+            tag = match.group("tag") if self.tags else None
+            if tag:
+                flags.add(self.tags[tag.lower()])
+            return ""
+        
+        return Mention(self._pattern.sub(strip, content).strip(), flags)
+
+# ---------------------------
+# Outbound chat queue
+# ---------------------------
+SEND_PRIORITY_HIGH = 0  # Owners, moderators and the broadcaster
+SEND_PRIORITY_NORMAL = 1
+SEND_LANES = ("high", "normal")
+
+class SendBucket:
+    """Allows at most limit messages in any period seconds.
+
+    A token bucket whose tokens come back one period after they were spent instead of
+    trickling back, so a burst followed by steady sending can never put more than limit
+    messages in one of Twitch's (or TwitchIO's) 30 second windows.
+    """
+
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = period
+        self._spent = collections.deque()  # send times within the last period
+
+    def _expire(self, now):
+        while self._spent and self._spent[0] <= now - self.period:
+            self._spent.popleft()
+
+    def available(self, now):
+        self._expire(now)
+        return self.limit - len(self._spent)
+
+    def wait_time(self, now):
+        """Seconds until a token is free, 0 if one is free now"""
+        if self.available(now) > 0:
+            return 0.0
+        return self._spent[0] + self.period - now
+
+    def take(self, now):
+        self._spent.append(now)
+
+class OutboundMessage:
+    __slots__ = ("bot", "channel", "text", "lane", "enqueued_at", "deadline", "future", "trace", "attempts", "not_before")
+
+    def __init__(self, bot, channel, text, lane, deadline, future):
+        self.bot = bot
+        self.channel = channel
+        self.text = text
+        self.lane = lane
+        self.enqueued_at = time.perf_counter()
+        self.deadline = deadline
+        self.future = future
+        self.trace = current_trace.get()
+        self.attempts = 0
+        self.not_before = 0.0  # no retry before this time
+
+class OutboundQueue:
+    """Sends chat messages no faster than Twitch allows, most important first.
+
+    Twitch counts messages per account, so one queue is shared by every shard. Sends to
+    channels where the bot is a moderator or broadcaster only count against the
+    CHAT_MOD_RATE_LIMIT bucket, other sends against both buckets. Lanes are served in
+    priority order. Messages still queued past their deadline are dropped instead of
+    answering a conversation chat has moved on from. When there are more messages
+    waiting than tokens left, messages queued for the same channel in the same lane are
+    merged into one, up to CHAT_MESSAGE_MAX_CHARS.
+
+    Messages for a shard whose connection is down stay queued until it's back (or their
+    deadline passes) while the other shards keep sending, and a failed send is put back
+    and retried after a backoff instead of holding up the queue.
+    """
+
+    def __init__(self, limit=CHAT_RATE_LIMIT, mod_limit=CHAT_MOD_RATE_LIMIT, period=CHAT_RATE_PERIOD):
+        self.regular = SendBucket(limit, period)
+        self.moderator = SendBucket(mod_limit, period)
+        self.period = period
+        self._lanes = [collections.deque() for _ in SEND_LANES]
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._last_sent = {}  # channel -> (text, time), for Twitch's duplicate message rule
+        self.sent = 0
+        self.merged = 0
+        self.dropped_stale = 0
+        self.failed = 0
+        self.deduplicated = 0
+        self.retried = 0
+        self._lags = collections.deque(maxlen=500)
+
+    def put(self, bot, channel, text, priority=SEND_PRIORITY_NORMAL, deadline=None):
+        """Queue a message to be sent over bot's connection.
+
+        Returns a future that resolves to True once the message was sent, False if it was
+        dropped or failed to send.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._lanes[priority].append(OutboundMessage(bot, channel, text, priority, deadline, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._send_loop())
+        self._wakeup.set()
+        return future
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for lane in self._lanes:
+            while lane:
+                self._finish(lane.popleft(), False)
+
+    def __len__(self):
+        return sum(len(lane) for lane in self._lanes)
+
+    def depths(self):
+        return {name: len(lane) for name, lane in zip(SEND_LANES, self._lanes)}
+
+    def _finish(self, message, sent, **details):
+        if not message.future.done():
+            message.future.set_result(sent)
+        if message.trace:
+            message.trace.add_span("send", message.enqueued_at, chars=len(message.text), **details)
+
+    def wake(self):
+        """Look at the queue again, e.g. because a shard's connection came back"""
+        self._wakeup.set()
+
+    def _next(self, now):
+        """The first sendable message of the highest lane, dropping the stale ones on the way.
+
+        Messages waiting for their shard to reconnect or for a retry are skipped over,
+        and so is everything queued after a retry for the same channel, so the chunks
+        of a reply can't overtake each other.
+        """
+        blocked = set()  # (bot, channel) with a message waiting to be retried
+        for lane in self._lanes:
+            for message in list(lane):
+                if message.deadline is not None and now >= message.deadline:
+                    lane.remove(message)
+                    self.dropped_stale += 1
+                    CHAT_SEND_DROPPED.inc(labels=("stale",))
+                    send_log.warning("Dropping reply to #%s queued for %.1fs: %s",
+                                     message.channel, now - message.enqueued_at, message.text)
+                    self._finish(message, False, dropped="stale")
+                elif (id(message.bot), message.channel) in blocked:
+                    continue
+                elif message.not_before > now:
+                    blocked.add((id(message.bot), message.channel))
+                elif message.bot.chat_ready():
+                    return message
+        return None
+
+    def _retry(self, messages, error):
+        """Put messages back at the front of their lane after a failed send, or give up on them"""
+        message = messages[0]
+        message.attempts += 1
+        if message.attempts >= CHAT_SEND_MAX_ATTEMPTS:
+            send_log.error("Failed to send to #%s after %d attempts: %s", message.channel, message.attempts, error)
+            SEND_FAILURES.inc()
+            return False
+        send_log.warning("Send to #%s failed (attempt %d/%d), retrying: %s",
+                         message.channel, message.attempts, CHAT_SEND_MAX_ATTEMPTS, error)
+        SEND_RETRIES.inc()
+        self.retried += 1
+        message.not_before = time.perf_counter() + 2 ** (message.attempts - 1)
+        self._lanes[message.lane].extendleft(reversed(messages))
+        return True
+
+    def _merge(self, message):
+        """Pull the queued messages for the same channel and lane into message, as far as they fit"""
+        lane = self._lanes[message.lane]
+        merged = []
+        length = len(message.text)
+        for other in list(lane):
+            if other.channel != message.channel or other.bot is not message.bot:
+                continue
+            if length + 1 + len(other.text) > CHAT_MESSAGE_MAX_CHARS:
+                break
+            merged.append(other)
+            length += 1 + len(other.text)
+        for other in merged:
+            lane.remove(other)
+        return merged
+
+    async def _send_loop(self):
+        while True:
+            now = time.perf_counter()
+            message = self._next(now)
+            if message is None:
+                self._wakeup.clear()
+                if not len(self):
+                    await self._wakeup.wait()
+                    continue
+                # Everything left waits for a reconnect or a retry, look again now and then for deadlines
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), 1)
+                continue
+
+            is_mod = message.bot.bot_is_mod(message.channel)
+            buckets = (self.moderator,) if is_mod else (self.regular, self.moderator)
+            wait = max(bucket.wait_time(now) for bucket in buckets)
+            if wait > 0:
+                # Checked again afterwards, a more important message may have arrived meanwhile
+                self._wakeup.clear()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                continue
+
+            self._lanes[message.lane].remove(message)
+            merged = []
+            if len(self) >= min(bucket.available(now) for bucket in buckets):
+                merged = self._merge(message)
+            text = " ".join([message.text] + [other.text for other in merged])
+
+            last = self._last_sent.get(message.channel)
+            if not is_mod and last and last[0] == text and now - last[1] < self.period:
+                text = text[:CHAT_MESSAGE_MAX_CHARS - len(CHAT_DUPLICATE_SUFFIX)] + CHAT_DUPLICATE_SUFFIX
+                self.deduplicated += 1
+
+            for bucket in buckets:
+                bucket.take(now)
+            try:
+                sent = await message.bot.send_chat(message.channel, text)
+            except (ConnectionError, aiohttp.ClientError) as e:
+                if self._retry([message] + merged, e):
+                    continue
+                sent = False
+            except Exception as e:
+                send_log.exception("Error sending to #%s: %s", message.channel, e)
+                sent = False
+
+            lag = now - message.enqueued_at
+            self._lags.append(lag)
+            CHAT_SEND_LAG_SECONDS.observe(lag, labels=(SEND_LANES[message.lane],))
+            if merged:
+                self.merged += len(merged)
+                CHAT_SEND_MERGED.inc(len(merged))
+            if sent:
+                self.sent += 1
+                self._last_sent[message.channel] = (text, time.perf_counter())
+            else:
+                self.failed += 1
+                CHAT_SEND_DROPPED.inc(1 + len(merged), labels=("failed",))
+            self._finish(message, sent, merged=len(merged))
+            for other in merged:
+                self._finish(other, sent, merged_into=True)
+
+    def stats(self):
+        now = time.perf_counter()
+        lags = list(self._lags)
+        return {
+            "queued": self.depths(),
+            "sent": self.sent,
+            "merged": self.merged,
+            "dropped_stale": self.dropped_stale,
+            "failed": self.failed,
+            "deduplicated": self.deduplicated,
+            "retried": self.retried,
+            "tokens_regular": self.regular.available(now),
+            "tokens_moderator": self.moderator.available(now),
+            "lag_p50": percentile(lags, 0.5),
+            "lag_p95": percentile(lags, 0.95),
+        }
+
+def reconnect_delay(failures):
+    """Seconds to wait before reconnecting after the given number of failures in a row.
+    
+    Exponential, capped at CHAT_RECONNECT_MAX_DELAY, with half of it randomized so
+    shards losing their connections together don't all hit Twitch at the same moment.
+    """
+    delay = min(CHAT_RECONNECT_MAX_DELAY, CHAT_RECONNECT_BASE_DELAY * 2 ** failures)
+    return random.uniform(delay / 2, delay)
+
+def reply_priority(author):
+    """Send lane for replies to a chatter: owners, moderators and the broadcaster go first"""
+    name = author.name.lower()
+    if author.is_mod or author.is_broadcaster or name in BOT_OWNERS or name in moderators:
+        return SEND_PRIORITY_HIGH
+    return SEND_PRIORITY_NORMAL
+
+# ---------------------------
+# Twitch Chat Bot using TwitchIO
+# ---------------------------
+class TwitchBot(commands.Bot):
+    def __init__(self, channels=None, shard=0, shared_with=None):
+        """One chat connection (shard) serving channels.
+        
+        Extra shards pass the first one as shared_with and reuse its LM Studio client,
+        scheduler and coalescer, so concurrency limits and caches cover every channel.
+        """
+        # TwitchIO has the chat endpoint hard-coded as a module constant
+        twitchio.websocket.HOST = TWITCH_IRC_WS_URL
+        self.channel_names = channels or [STREAMER_CHANNEL]
+        self.shard = shard
+        super().__init__(
+            token=f"oauth:{TWITCH_OAUTH_TOKEN}",
+            prefix="!",
+            initial_channels=self.channel_names
+        )
+        self.simulated_chat = urllib.parse.urlparse(TWITCH_IRC_WS_URL).hostname != "irc-ws.chat.twitch.tv"
+        if self.simulated_chat:
+            # Anything else is a local simulator, which can't validate the token with Twitch's API
+            self._http.nick = TWITCH_USERNAME.lower()
+        self.owns_llm = shared_with is None
+        if self.owns_llm:
+            # One pooled LM Studio client per bot instead of a thread + new connection per mention
+            self.llm_client = LMStudioClient()
+            self.llm_scheduler = LLMScheduler()
+            self.inflight_requests = InflightCoalescer()
+            # Twitch's rate limits are per account, so every shard sends through one queue
+            self.outbound = OutboundQueue()
+        else:
+            self.llm_client = shared_with.llm_client
+            self.llm_scheduler = shared_with.llm_scheduler
+            self.inflight_requests = shared_with.inflight_requests
+            self.outbound = shared_with.outbound
+        self.mention_scanner = MentionScanner([TWITCH_USERNAME] + BOT_ALIASES)
+        self._background_tasks = set()  # Strong references so summaries aren't garbage collected mid-flight
+        self._supervisor = None  # One per shard for its whole life, TwitchIO reconnects underneath it
+        self._ping_token = None
+        self._pong = None
+        self._pings = 0
+        self._websocket = None  # the connection the supervisor last saw up
+        self._reconnect_reason = None
+        self.ping_rtt = None
+        self.reconnects = 0
+        
+    async def connect(self):
+        if self.simulated_chat and self._http.session is None:
+            # Normally created while validating the token, which is skipped for the simulator
+            self._http.session = aiohttp.ClientSession()
+        await super().connect()
+        
+    async def event_ready(self):
+        if self._supervisor is None or self._supervisor.done():
+            self._supervisor = asyncio.create_task(self._supervise())
+        bot_log.info("Logged in as | %s (shard %d)", self.nick, self.shard)
+        self.llm_client.start_health_checks()
+        if conversation_store:
+            conversation_store.start()
+        await self.join_channels(self.channel_names)
+        await asyncio.sleep(1)
+        bot_log.info("TwitchIO shard %d connected channels: %s", self.shard,
+                     ", ".join(channel.name for channel in self.connected_channels))
+        
+    async def event_reconnect(self):
+        bot_log.warning("Twitch asked shard %d to reconnect", self.shard)
+        self._reconnect_reason = "requested"
+
+    async def event_raw_data(self, data):
+        # TwitchIO also passes on the close code when the server closes the socket
+        if self._ping_token and isinstance(data, str) and self._ping_token in data and not self._pong.done():
+            self._pong.set_result(time.perf_counter())
+
+    def chat_ready(self):
+        """Whether this shard is connected and logged in, so chat messages can be sent.
+        
+        TwitchIO starts its receive loop once it has logged in. Its is_ready isn't used,
+        it isn't set again after a reconnect.
+        """
+        keeper = self._connection._keeper
+        return self._connection.is_alive and keeper is not None and not keeper.done()
+
+    def _check_reconnected(self):
+        websocket = self._connection._websocket
+        if websocket is self._websocket or not self.chat_ready():
+            return
+        if self._websocket is not None:
+            reason = self._reconnect_reason or "dropped"
+            bot_log.info("Shard %d reconnected (%s)", self.shard, reason)
+            WEBSOCKET_RECONNECTS.inc(labels=(reason,))
+            self.reconnects += 1
+            # TwitchIO only sets it on the first login, its handler for this login waits on it
+            self._connection.is_ready.set()
+            # Replies held back while the connection was down can go out now
+            self.outbound.wake()
+        self._websocket = websocket
+        self._reconnect_reason = None
+
+    async def _supervise(self):
+        """Keep this shard's chat connection alive, one task for the shard's whole life.
+        
+        PINGs Twitch every CHAT_PING_INTERVAL and reopens the connection if the PONG
+        doesn't come back, since TwitchIO only answers Twitch's PINGs and a connection
+        that silently stopped delivering would go unnoticed. Also reopens it when
+        TwitchIO's receive loop died instead of reconnecting, which it does when the
+        server closes the socket cleanly. Until a PONG comes back again, every further
+        reconnect waits a little longer.
+        """
+        failures = 0
+        last_ping = time.monotonic()
+        while True:
+            await asyncio.sleep(CHAT_CHECK_INTERVAL)
+            self._check_reconnected()
+            keeper = self._connection._keeper
+            if keeper is not None and keeper.done() and not keeper.cancelled() and keeper.exception():
+                bot_log.warning("Chat connection of shard %d was lost: %r", self.shard, keeper.exception())
+                await self._reconnect(failures, "lost")
+                failures += 1
+                continue
+            if not self.chat_ready() or time.monotonic() - last_ping < CHAT_PING_INTERVAL:
+                continue
+
+            last_ping = time.monotonic()
+            self._pings += 1
+            self._ping_token = f"cyrai-{self.shard}-{self._pings}"
+            self._pong = asyncio.get_running_loop().create_future()
+            sent_at = time.perf_counter()
+            try:
+                await self._connection.send(f"PING :{self._ping_token}")
+                received_at = await asyncio.wait_for(self._pong, CHAT_PONG_TIMEOUT)
+            except asyncio.TimeoutError:
+                bot_log.warning("No PONG from Twitch within %ds on shard %d", CHAT_PONG_TIMEOUT, self.shard)
+                # Stop TwitchIO's receive loop first, it would reconnect right away on its own
+                self._connection._keeper.cancel()
+                await self._connection._websocket.close()
+                await self._reconnect(failures, "ping_timeout")
+                failures += 1
+                continue
+            except (ConnectionError, aiohttp.ClientError) as e:
+                bot_log.warning("Keep-alive PING failed on shard %d: %s", self.shard, e)
+                continue
+            finally:
+                self._ping_token = None
+            failures = 0
+            self.ping_rtt = received_at - sent_at
+            CHAT_PING_RTT_SECONDS.observe(self.ping_rtt, labels=(str(self.shard),))
+
+    async def _reconnect(self, failures, reason):
+        """Reopen the chat connection after a jittered backoff, replies meanwhile stay queued"""
+        delay = reconnect_delay(failures)
+        bot_log.warning("Reconnecting shard %d in %.1f seconds", self.shard, delay)
+        await asyncio.sleep(delay)
+        self._reconnect_reason = reason
+        try:
+            # Logs in and rejoins the shard's channels, retrying with TwitchIO's own backoff
+            await self._connection._connect()
+        except Exception as e:
+            bot_log.exception("Reconnecting shard %d failed: %s", self.shard, e)
+        self._check_reconnected()
+        
+    async def event_message(self, message):
+        if message.echo:
+            # Our own replies, TwitchIO dispatches them like received messages
+            return
+        received_at = time.perf_counter()
+        channel = get_channel(message.channel.name)
+        channel.messages += 1
+        MESSAGES_RECEIVED.inc(labels=(channel.name,))
+        
+        if not message.author or message.author.name.lower() == TWITCH_USERNAME.lower():
+            return
+        
+        author_name = message.author.name
+        mention = self.mention_scanner.scan(message.content)
+        # Messages that don't mention the bot are most of chat, that category is sampled (LOG_SAMPLE_RATES)
+        (chat_log if mention else received_log).info(
+            "Received message from %s in channel: %s", author_name, channel.name
+        )
+        
+        if mention:
+            if not channel.allows(message.author.name.lower()):
+                chat_log.info("User %s not whitelisted. Ignoring.", message.author.name)
+                WHITELIST_REJECTS.inc()
+                return
+            
+            # The bot's names and tags like (global) are already stripped from the prompt
+            user_prompt = mention.prompt or "Hello"
+            is_global = "global" in mention.flags
+            priority = reply_priority(message.author)
+            deadline = received_at + CHAT_REPLY_DEADLINE
+            MENTIONS.inc(labels=(channel.name, "global" if is_global else "user"))
+            channel.mentions += 1
+            trace = None
+            if TRACING_ENABLED:
+                trace = Trace(author_name, "global" if is_global else "user", channel.name)
+                trace.started = received_at
+                current_trace.set(trace)
+                chat_log.debug("Tracing mention from %s as %s", author_name, trace.trace_id)
+            if trace:
+                trace.add_span("parse", received_at)
+            
+            # Choose the appropriate context, both are namespaced by channel
+            user_id = channel.conversation_key(message.author.name.lower())
+            if is_global:
+                chat_log.debug("Using global context of #%s for user %s", channel.name, author_name)
+                message_history = await channel.load_global_conversation()
+            else:
+                # Get or initialize user's conversation context
+                message_history = await user_conversations.get(user_id)
+                chat_log.debug("Using individual context for user %s", author_name)
+            
+            # Make room for the new prompt and the reply before it's sent
+            _, reply_tokens = reply_budget(author_name)
+            with trace_span("context_fit"):
+                self.fit_context(message_history, reserve=ContextBudgeter.message_tokens(user_prompt), keep=0,
+                                 prompt=channel.system_prompt, max_tokens=reply_tokens)
+            
+            generation_started = time.perf_counter()
+            channel.in_flight += 1
+            outcome = None
+            try:
+                if is_global and COALESCE_GLOBAL_PROMPTS:
+                    # Chatters tagging the same (global) question share one generation
+                    request_key = ResponseCache.make_key(
+                        channel.system_prompt, LM_STUDIO_MODEL, DEFAULT_TEMPERATURE, DEFAULT_MAX_TOKENS,
+                        message_history, user_prompt
+                    )
+                    (ai_response, streamed), shared = await self.inflight_requests.run(
+                        request_key,
+                        lambda: self.generate_reply(
+                            user_id, message.author.name, user_prompt, message_history, channel,
+                            use_cache=RESPONSE_CACHE_ENABLED, cache_key=request_key,
+                            priority=priority, deadline=deadline
+                        )
+                    )
+                else:
+                    ai_response, streamed = await self.generate_reply(
+                        user_id, message.author.name, user_prompt, message_history, channel,
+                        use_cache=RESPONSE_CACHE_ENABLED, priority=priority, deadline=deadline
+                    )
+                    shared = False
+                
+                if shared:
+                    # The request that did the generation already recorded the exchange and
+                    # replied to its own author, this chatter still needs their own reply
+                    chat_log.info("Shared in-flight global reply with %s", author_name)
+                    if trace:
+                        trace.add_span("coalesced_wait", generation_started)
+                    streamed = False
+                else:
+                    # Update the appropriate conversation history with this exchange
+                    # First add the user message if not already in history
+                    last = message_history.last()
+                    if last is None or last.role != "user" or last.content != user_prompt:
+                        message_history.append("user", user_prompt)
+                    
+                    # Then add the assistant's response
+                    message_history.append("assistant", ai_response)
+                    
+                    # Prevent context from growing past the model's window, always keeping the latest exchange
+                    with trace_span("history_update"):
+                        self.fit_context(message_history, prompt=channel.system_prompt)
+                        if conversation_store:
+                            conversation_store.mark_dirty(message_history)
+                
+                    if is_global:
+                        chat_log.debug("Global context of #%s updated, now has %d messages", channel.name, len(message_history))
+                    else:
+                        chat_log.debug("User %s context updated, now has %d messages", user_id, len(message_history))
+                
+                if not streamed:
+                    reply = f"@{message.author.name} {ai_response}"
+                    await self.handle_reply(reply, channel.name, priority, deadline)
+                reply_seconds = time.perf_counter() - received_at
+                channel.record_reply(reply_seconds)
+                MENTION_REPLY_SECONDS.observe(reply_seconds, labels=(channel.name,))
+            except LLMQueueFullError as e:
+                chat_log.warning("Dropping mention from %s in #%s: %s", author_name, channel.name, e)
+                outcome = "queue_full"
+            except Exception:
+                # Don't let one bad mention take the handler down, TwitchIO would only print it
+                chat_log.exception("Unexpected error answering %s in #%s", author_name, channel.name)
+                outcome = "error"
+            finally:
+                channel.in_flight -= 1
+                if trace:
+                    trace.finish(outcome)
+        
+        await self.handle_commands(message)
+
+    async def generate_reply(self, user_id, author_name, prompt, message_history, channel, use_cache=True,
+                             cache_key=None, priority=SEND_PRIORITY_NORMAL, deadline=None):
+        """Get the AI reply for a prompt in a channel, from the cache or through the scheduler.
+        
+        Returns (reply_text, streamed); when streamed is True the reply was already sent to chat.
+        Raises LLMQueueFullError when the scheduler has no room for the request.
+        """
+        if not use_cache:
+            cache_key = None
+        else:
+            if cache_key is None:
+                cache_key = ResponseCache.make_key(
+                    channel.system_prompt, LM_STUDIO_MODEL, DEFAULT_TEMPERATURE, DEFAULT_MAX_TOKENS, message_history,
+                    prompt
+                )
+            with trace_span("cache_lookup") as details:
+                cached = response_cache.get(cache_key)
+                details["hit"] = cached is not None
+            if cached is not None:
+                chat_log.info("Response cache hit for %s", author_name)
+                return cached, False
+        
+        enqueued_at = time.perf_counter()
+        
+        async def generate():
+            trace = current_trace.get()
+            if trace:
+                trace.add_span("queue_wait", enqueued_at)
+            try:
+                if LM_STUDIO_STREAM:
+                    # Chunks are sent to chat as they finish, the full text comes back for the history
+                    ai_response, complete = await self.stream_reply(
+                        author_name, prompt, message_history, channel, priority, deadline
+                    )
+                else:
+                    max_chars, max_tokens = reply_budget(author_name)
+                    ai_response = await self.llm_client.complete(
+                        prompt=prompt,
+                        temperature=DEFAULT_TEMPERATURE,
+                        max_tokens=max_tokens,
+                        system_prompt=channel.system_prompt,
+                        model=LM_STUDIO_MODEL,
+                        num_ctx=DEFAULT_NUM_CTX,
+                        message_history=message_history
+                    )
+                    # The history gets what chat gets
+                    ai_response = trim_reply(ai_response, max_chars)
+                    complete = True
+            except LLMError as e:
+                # Nothing reached chat yet, the error text is sent as the reply
+                if trace:
+                    trace.outcome = "llm_error"
+                return str(e), False
+            
+            if cache_key and complete:
+                response_cache.put(cache_key, ai_response)
+            return ai_response, LM_STUDIO_STREAM
+        
+        return await self.llm_scheduler.run(user_id, generate)
+
+    async def stream_reply(self, author_name, prompt, message_history, channel, priority=SEND_PRIORITY_NORMAL,
+                           deadline=None):
+        """Stream a completion and send it to the channel's chat sentence by sentence.
+        
+        Generation stops as soon as the reply has filled its chat allowance (reply_budget),
+        so the backend doesn't spend time on text that would be cut off anyway.
+        
+        Returns (sent_text, complete). Raises LLMError if the stream failed before anything was sent.
+        """
+        max_chars, max_tokens = reply_budget(author_name)
+        received = False
+        pending = ""
+        kept = []  # Chunks queued for chat, which is also what the history gets
+        used = 0  # Characters of the allowance taken by kept chunks
+        sends = []
+        complete = True
+        stopped = False
+        
+        def room():
+            # Chunks are joined with a space
+            return max_chars - used - (1 if kept else 0)
+        
+        def queue(chunk):
+            nonlocal used
+            # Only the first chunk carries the @mention, the rest read as a continuation
+            sends.append(self.handle_reply(
+                f"@{author_name} {chunk}" if not kept else chunk, channel.name, priority, deadline
+            ))
+            used = max_chars - room() + len(chunk)
+            kept.append(chunk)
+        
+        try:
+            async with contextlib.aclosing(self.llm_client.stream(
+                prompt=prompt,
+                temperature=DEFAULT_TEMPERATURE,
+                max_tokens=max_tokens,
+                system_prompt=channel.system_prompt,
+                model=LM_STUDIO_MODEL,
+                num_ctx=DEFAULT_NUM_CTX,
+                message_history=message_history
+            )) as pieces:
+                async for piece in pieces:
+                    received = True
+                    pending += piece
+                    
+                    chunks, pending = split_ready_chunks(pending)
+                    for index, chunk in enumerate(chunks):
+                        if len(chunk) > room():
+                            # Put back, it's trimmed to what's left below
+                            pending = " ".join(chunks[index:] + [pending])
+                            stopped = True
+                            break
+                        queue(chunk)
+                    if stopped or len(pending.strip()) > room():
+                        # Leaving the loop closes the stream, which ends generation on the backend
+                        stopped = True
+                        break
+        except LLMError:
+            if not received:
+                raise
+            # Keep whatever made it through, but don't treat the cut-off text as a full reply
+            complete = False
+        
+        if stopped:
+            LLM_EARLY_STOPS.inc()
+            llm_log.debug("Stopped generating for %s after %d of %d chars", author_name, used, max_chars)
+        pending = pending.strip()
+        if pending and not (stopped and kept):
+            # The unfinished sentence of a stopped reply is dropped unless it's all there is
+            queue(trim_reply(pending, room()))
+        if not kept:
+            raise LLMError("Sorry, I received an empty response from the AI.")
+        # Keeping the generation slot until chat caught up stops the bot from generating
+        # replies faster than Twitch lets it send them
+        await asyncio.gather(*sends)
+        
+        return " ".join(kept), complete
+
+    def fit_context(self, conversation, reserve=0, keep=2, prompt=None, max_tokens=None):
+        """Trim a conversation to the context budget, summarizing what was trimmed if compaction is on"""
+        context_budget.fit(conversation, prompt or system_prompt, reserve=reserve, keep=keep, max_tokens=max_tokens)
+        if conversation.pending and not conversation.compacting:
+            conversation.compacting = True
+            task = asyncio.create_task(self.compact_conversation(conversation))
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
+    
+    async def compact_conversation(self, conversation):
+        """Fold evicted turns into the conversation's rolling summary using a low-priority LLM call"""
+        # Started from a mention's task, but the summary isn't part of that mention's trace
+        current_trace.set(None)
+        try:
+            while conversation.pending:
+                turns, conversation.pending = conversation.pending, None
+                transcript = "\n".join(f"{msg.role}: {msg.content}" for msg in turns)
+                if conversation.summary is not None:
+                    previous = conversation.summary.content[len(SUMMARY_LABEL):]
+                    transcript = f"Previous summary: {previous}\n\nNew turns:\n{transcript}"
+                
+                async def summarize():
+                    return await self.llm_client.complete(
+                        prompt=transcript,
+                        temperature=SUMMARY_TEMPERATURE,
+                        max_tokens=SUMMARY_MAX_TOKENS,
+                        system_prompt=SUMMARY_SYSTEM_PROMPT,
+                        model=LM_STUDIO_MODEL,
+                        num_ctx=DEFAULT_NUM_CTX
+                    )
+                
+                try:
+                    summary = await self.llm_scheduler.run(None, summarize, background=True)
+                except (LLMError, LLMQueueFullError) as e:
+                    # Same outcome as running without compaction: those turns are forgotten
+                    llm_log.warning("Skipping conversation summary: %s", e)
+                    continue
+                conversation.set_summary(summary.strip())
+                if conversation_store:
+                    conversation_store.mark_dirty(conversation)
+                llm_log.info("Conversation summary updated (%d tokens)", conversation.summary.tokens)
+        finally:
+            conversation.compacting = False
+
+    async def close(self):
+        if self._supervisor:
+            self._supervisor.cancel()
+        if self.owns_llm:
+            if conversation_store:
+                await conversation_store.stop()
+            await self.llm_client.close()
+            await self.outbound.stop()
+        await super().close()
+
+    def handle_reply(self, reply, channel=None, priority=SEND_PRIORITY_NORMAL, deadline=None):
+        """Queue a reply for a channel's chat (STREAMER_CHANNEL by default).
+        
+        Returns an awaitable that finishes once the reply was sent, or dropped from the
+        outbound queue because its deadline passed.
+        """
+        name = (channel or STREAMER_CHANNEL).lstrip("#").lower()
+        parts = split_message(reply) if len(reply) > CHAT_MESSAGE_MAX_CHARS else [reply]
+        sends = [self.outbound.put(self, name, part, priority, deadline) for part in parts]
+        return sends[0] if len(sends) == 1 else asyncio.gather(*sends)
+    
+    def bot_is_mod(self, channel):
+        """Whether the bot is a moderator or the broadcaster in a channel, as far as TwitchIO has seen"""
+        return bool(twitchio.Channel(name=channel, websocket=self._connection)._bot_is_mod())
+    
+    async def send_chat(self, channel, text):
+        """Write one chat message to the channel over this shard's TwitchIO connection.
+        
+        Called by the outbound queue once the rate limit allows it, which keeps the
+        message and retries it if this raises a connection error. The PRIVMSG is written
+        directly: Channel.send would check TwitchIO's own rate bucket as well, which
+        counts the message before checking and so refuses the 20th one of a window.
+        """
+        if not self.chat_ready():
+            raise ConnectionError("chat connection is down")
+        # TwitchIO still dispatches it back as an echo message
+        await self._connection.send(f"PRIVMSG #{channel} :{text}")
+        send_log.info("Sent reply to #%s: %s", channel, text)
+        MESSAGES_SENT.inc()
+        return True
+
+def build_lm_studio_messages(prompt, system_prompt, message_history=None):
+    # Start with the system message
+    messages = [{"role": "system", "content": system_prompt}]
+    
+    # Add conversation history if available
+    last = None
+    if message_history:
+        messages.extend(message_history.to_messages())
+        last = message_history.last()
+    
+    # Add the current user message if not already included in history
+    if last is None or last.role != "user" or last.content != prompt:
+        messages.append({"role": "user", "content": prompt})
+    
+    return messages
+
+# ---------------------------
+# LLM backend pool
+# ---------------------------
+class LLMBackend:
+    """One OpenAI-compatible endpoint with its load, latency and circuit-breaker state.
+    
+    closed: takes traffic. open: requests or health probes failed LLM_CIRCUIT_FAILURE_THRESHOLD
+    times in a row and it is skipped without waiting on a timeout. half_open: the
+    open period is over or a probe succeeded, and a single trial request decides whether
+    it closes again or goes back to open.
+    """
+    
+    def __init__(self, url):
+        self.url = url
+        self.models_url = url.rsplit("/chat/completions", 1)[0] + "/models"
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.consecutive_probe_failures = 0
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        # Time to first token, what balancing and hedging go by
+        self.latency_ewma = None
+        self.latencies = collections.deque(maxlen=200)
+        # Whole non-streamed completions, only reported, their length depends on max_tokens
+        self.completion_latencies = collections.deque(maxlen=200)
+    
+    def available(self, now):
+        if self.state == "open" and now - self.opened_at >= LLM_CIRCUIT_OPEN_DURATION:
+            self.state = "half_open"
+        if self.state == "half_open":
+            return not self.trial_in_flight
+        return self.state == "closed"
+    
+    def start(self):
+        """Count a request as outstanding, returns whether it's the half-open trial"""
+        self.outstanding += 1
+        if self.state == "half_open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+    
+    def finish(self, trial=False):
+        self.outstanding -= 1
+        if trial:
+            # Requests started before the circuit opened don't end the trial
+            self.trial_in_flight = False
+    
+    def record_success(self, first_token=None):
+        self.requests += 1
+        self.consecutive_errors = 0
+        if self.state != "closed":
+            llm_log.info("Circuit closed for LM Studio backend %s", self.url)
+            self.state = "closed"
+        if first_token is not None:
+            self.record_first_token(first_token)
+    
+    def record_first_token(self, latency):
+        self.latencies.append(latency)
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma += LLM_LATENCY_EWMA_ALPHA * (latency - self.latency_ewma)
+    
+    def record_failure(self):
+        self.requests += 1
+        self.errors += 1
+        self.consecutive_errors += 1
+        if self.state == "half_open" or self.consecutive_errors >= LLM_CIRCUIT_FAILURE_THRESHOLD:
+            self.trip(f"{self.consecutive_errors} consecutive errors")
+    
+    def record_probe(self, healthy):
+        if healthy:
+            self.consecutive_probe_failures = 0
+            if self.state == "open":
+                # Let the next request through as a trial instead of waiting out the open period
+                llm_log.info("LM Studio backend %s answered its health check, half-opening circuit", self.url)
+                self.state = "half_open"
+            return
+        self.consecutive_probe_failures += 1
+        if self.state != "closed" or self.consecutive_probe_failures >= LLM_CIRCUIT_FAILURE_THRESHOLD:
+            self.trip(f"{self.consecutive_probe_failures} failed health checks")
+    
+    def trip(self, reason):
+        if self.state != "open":
+            llm_log.warning("Circuit opened for LM Studio backend %s after %s", self.url, reason)
+        self.state = "open"
+        self.opened_at = time.monotonic()
+    
+    def stats(self):
+        latencies = list(self.latencies)
+        completion_latencies = list(self.completion_latencies)
+        return {
+            "url": self.url,
+            "state": self.state,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "error_rate": self.errors / self.requests if self.requests else 0.0,
+            "latency_ewma": self.latency_ewma,
+            "latency_p50": percentile(latencies, 0.5),
+            "latency_p95": percentile(latencies, 0.95),
+            "completion_p50": percentile(completion_latencies, 0.5),
+            "completion_p95": percentile(completion_latencies, 0.95),
+        }
+
+class BackendPool:
+    """Picks a backend per request and keeps track of which ones are fit to take traffic.
+    
+    Backends drop out when their circuit opens (repeated request or health probe
+    failures) and come back through a half-open trial once a probe succeeds or the
+    open period runs out.
+    """
+    
+    def __init__(self, urls, strategy=LLM_BALANCING):
+        self.backends = [LLMBackend(url) for url in urls]
+        self.strategy = strategy
+        self.fail_fast = 0
+    
+    def select(self, exclude=()):
+        """The best available backend not in exclude, or None when there is none"""
+        now = time.monotonic()
+        candidates = [backend for backend in self.backends if backend not in exclude and backend.available(now)]
+        if not candidates:
+            return None
+        if self.strategy == "latency":
+            # Backends without a measurement yet count as average, so their load still weighs in
+            measured = [backend.latency_ewma for backend in self.backends if backend.latency_ewma is not None]
+            default = sum(measured) / len(measured) if measured else LLM_HEDGE_DEFAULT_DELAY
+            return min(candidates, key=lambda backend: (backend.outstanding + 1) * (
+                default if backend.latency_ewma is None else backend.latency_ewma))
+        return min(candidates, key=lambda backend: (backend.outstanding, backend.latency_ewma or 0.0))
+    
+    def hedge_delay(self):
+        """How long to wait for the first token before hedging: the pool's recent p95, floored"""
+        latencies = [latency for backend in self.backends for latency in backend.latencies]
+        if len(latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return LLM_HEDGE_DEFAULT_DELAY
+        return max(LLM_HEDGE_MIN_DELAY, percentile(latencies, 0.95))
+    
+    async def probe(self, session):
+        async def check(backend):
+            try:
+                timeout = aiohttp.ClientTimeout(total=LLM_HEALTH_CHECK_TIMEOUT)
+                async with session.get(backend.models_url, timeout=timeout) as response:
+                    healthy = response.status == 200
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                healthy = False
+            backend.record_probe(healthy)
+        
+        await asyncio.gather(*(check(backend) for backend in self.backends))
+    
+    async def run_health_checks(self, get_session):
+        while True:
+            try:
+                await self.probe(get_session())
+            except Exception as e:
+                llm_log.warning("LM Studio health check error: %s", e)
+            await asyncio.sleep(LLM_HEALTH_CHECK_INTERVAL)
+    
+    def stats(self):
+        return [backend.stats() for backend in self.backends]
+
+# ---------------------------
+# Prompt prefix reuse tracking
+# ---------------------------
+class PrefixCacheTracker:
+    """Estimates how much of each prompt the backend could serve from its KV cache.
+    
+    llama.cpp keeps one cached prompt per slot, so a request can only skip prefill for the
+    leading messages it shares with one of the last few prompts the server processed.
+    """
+    
+    def __init__(self, slots=PREFIX_CACHE_SLOTS):
+        self._recent = collections.deque(maxlen=slots)  # (message keys, cumulative token counts)
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.reused_tokens = 0
+        self.last_reused_fraction = 0.0
+    
+    def observe(self, messages):
+        """Record a prompt and return (reused_tokens, prompt_tokens) for it"""
+        keys = []
+        cumulative = []
+        total = 0
+        for msg in messages:
+            keys.append((msg["role"], msg["content"]))
+            total += ContextBudgeter.message_tokens(msg["content"])
+            cumulative.append(total)
+        
+        reused = 0
+        for recent_keys, recent_cumulative in self._recent:
+            shared = 0
+            for key, recent_key in zip(keys, recent_keys):
+                if key != recent_key:
+                    break
+                shared += 1
+            if shared:
+                reused = max(reused, min(cumulative[shared - 1], recent_cumulative[shared - 1]))
+        self._recent.append((keys, cumulative))
+        
+        self.requests += 1
+        self.prompt_tokens += total
+        self.reused_tokens += reused
+        self.last_reused_fraction = reused / total if total else 0.0
+        return reused, total
+    
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "reused_prefix_tokens": self.reused_tokens,
+            "reused_fraction": self.reused_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+            "last_reused_fraction": self.last_reused_fraction,
+        }
+
+# ---------------------------
+# Async LM Studio client
+# ---------------------------
+class LLMError(Exception):
+    """A failed completion; the message is safe to show in chat"""
+    
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable  # True when another backend might succeed (network errors, 5xx)
+
+class LMStudioClient:
+    """Keep-alive HTTP client for the LM Studio API, shared for the whole lifetime of a TwitchBot.
+    
+    Requests are spread over the backends in LM_STUDIO_API_URLS; a request that fails
+    with a network error or 5xx is retried on another backend, and with hedging on a
+    request that is slow to start is raced against a second backend.
+    """
+    
+    def __init__(self, api_urls=LM_STUDIO_API_URLS):
+        self.backends = BackendPool(api_urls)
+        self._session = None
+        self._health_task = None
+        self.prefix_cache = PrefixCacheTracker()
+        self.hedges_fired = 0
+        self.hedges_won = 0
+    
+    def _get_session(self):
+        # The session has to be created inside the running event loop, so it's built on first use
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=LM_STUDIO_MAX_CONNECTIONS,
+                keepalive_timeout=LM_STUDIO_KEEPALIVE_TIMEOUT
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=LM_STUDIO_REQUEST_TIMEOUT,
+                connect=LM_STUDIO_CONNECT_TIMEOUT,
+                sock_read=LM_STUDIO_READ_TIMEOUT
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+    
+    def start_health_checks(self):
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.create_task(self.backends.run_health_checks(self._get_session))
+    
+    async def close(self):
+        if self._health_task:
+            self._health_task.cancel()
+            self._health_task = None
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    async def complete(self, prompt, temperature, max_tokens, system_prompt, model, num_ctx, message_history=None):
+        """Return the completion text; raises LLMError with a chat-friendly message on failure"""
+        messages = build_lm_studio_messages(prompt, system_prompt, message_history)
+        payload = self._payload(messages, temperature, max_tokens, model, stream=False)
+        llm_log.debug("Sending request to LM Studio API with %d messages in context", len(messages))
+        
+        started = time.perf_counter()
+        tried = []
+        while True:
+            try:
+                backend = self._select(tried)
+                if LLM_HEDGING_ENABLED:
+                    content = await self._race(
+                        lambda hedge_backend: self._complete_on(hedge_backend, payload),
+                        backend, tried
+                    )
+                else:
+                    content = await self._complete_on(backend, payload)
+                self._record_request("complete", "ok", started, tried)
+                return content
+            except LLMError as e:
+                if not e.retryable or self.backends.select(exclude=tried) is None:
+                    self._record_request("complete", "error", started, tried)
+                    raise
+                llm_log.warning("Retrying on another LM Studio backend after: %s", e)
+    
+    def _select(self, tried):
+        backend = self.backends.select(exclude=tried)
+        if backend is None:
+            # Every circuit is open: say so right away instead of sitting on a timeout
+            self.backends.fail_fast += 1
+            raise self._error("Sorry, the AI is unavailable right now. Try again in a bit.")
+        tried.append(backend)
+        return backend
+    
+    async def _race(self, attempt, backend, tried, discard=None):
+        """Await attempt(backend), and if it's slower than the hedge delay also attempt(another backend).
+        
+        The first attempt to succeed wins and the other one is cancelled; a second success
+        that finishes in the same instant is handed to discard() for cleanup.
+        """
+        attempts = [asyncio.create_task(attempt(backend))]
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=self.backends.hedge_delay())
+            hedge_backend = None if done else self.backends.select(exclude=tried)
+            if hedge_backend is not None:
+                tried.append(hedge_backend)
+                self.hedges_fired += 1
+                llm_log.info("Hedging slow request to %s with %s", backend.url, hedge_backend.url)
+                attempts.append(asyncio.create_task(attempt(hedge_backend)))
+            
+            pending = set(attempts)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winners = [task for task in attempts if task in done and task.exception() is None]
+                if winners:
+                    if winners[0] is not attempts[0]:
+                        self.hedges_won += 1
+                    for loser in winners[1:]:
+                        if discard:
+                            await discard(loser.result())
+                    return winners[0].result()
+                if not pending:
+                    # Everything failed, report the primary's error
+                    return attempts[0].result()
+        finally:
+            for task in attempts:
+                if not task.done():
+                    task.cancel()
+    
+    async def _complete_on(self, backend, payload):
+        started = time.monotonic()
+        trial = backend.start()
+        try:
+            async with self._get_session().post(backend.url, json=payload) as response:
+                llm_log.debug("Received response with status code: %d from %s", response.status, backend.url)
+                
+                if response.status != 200:
+                    body = await response.text(errors="replace")
+                    if body:
+                        llm_log.warning("Response content: %s", body)
+                    raise LLMError(
+                        f"Error: Failed to contact LM Studio API. Status code: {response.status}",
+                        retryable=response.status >= 500
+                    )
+                
+                data = await response.json(content_type=None)
+        except LLMError as e:
+            llm_log.warning("%s", e)
+            if e.retryable:
+                backend.record_failure()
+            raise
+        except aiohttp.ClientError as e:
+            backend.record_failure()
+            raise self._error(f"Network error when contacting LM Studio API: {str(e)}", retryable=True)
+        except asyncio.TimeoutError:
+            backend.record_failure()
+            raise self._error("Network error when contacting LM Studio API: request timed out", retryable=True)
+        except json.JSONDecodeError as e:
+            raise self._error(f"Failed to parse LM Studio response as JSON: {str(e)}")
+        except Exception as e:
+            raise self._error(f"Unexpected error when calling LM Studio API: {str(e)}")
+        finally:
+            backend.finish(trial)
+        backend.record_success()
+        backend.completion_latencies.append(time.monotonic() - started)
+        
+        # Extract the message content from the LM Studio response format
+        if "choices" not in data or len(data["choices"]) == 0:
+            raise self._error("Sorry, I couldn't understand the AI's response format.")
+        content = data["choices"][0].get("message", {}).get("content", "")
+        if not content:
+            raise self._error("Sorry, I received an empty response from the AI.")
+        usage = data.get("usage") or {}
+        LLM_TOKENS_GENERATED.inc(usage.get("completion_tokens") or count_tokens(content))
+        return content
+    
+    async def stream(self, prompt, temperature, max_tokens, system_prompt, model, num_ctx, message_history=None):
+        """Yield the completion text piece by piece as LM Studio streams it (OpenAI-style SSE).
+        
+        Raises LLMError if the request fails, including part-way through the stream. A
+        backend that fails before sending anything is swapped for another one.
+        """
+        messages = build_lm_studio_messages(prompt, system_prompt, message_history)
+        payload = self._payload(messages, temperature, max_tokens, model, stream=True)
+        llm_log.debug("Streaming request to LM Studio API with %d messages in context", len(messages))
+        
+        started = time.perf_counter()
+        first_token_at = None
+        outcome = "error"
+        tried = []
+        try:
+            while True:
+                backend = self._select(tried)
+                try:
+                    if LLM_HEDGING_ENABLED:
+                        pieces, first = await self._race(
+                            lambda hedge_backend: self._first_piece(self._stream_on(hedge_backend, payload)),
+                            backend, tried,
+                            discard=lambda result: result[0].aclose()
+                        )
+                    else:
+                        pieces, first = await self._first_piece(self._stream_on(backend, payload))
+                except LLMError as e:
+                    if not e.retryable or self.backends.select(exclude=tried) is None:
+                        raise
+                    llm_log.warning("Retrying on another LM Studio backend after: %s", e)
+                    continue
+                
+                if first is not None:
+                    first_token_at = time.perf_counter()
+                    LLM_FIRST_TOKEN_SECONDS.observe(first_token_at - started)
+                    try:
+                        yield first
+                        async for piece in pieces:
+                            yield piece
+                    finally:
+                        # Also when the caller stops reading early: closing the response is
+                        # what tells the backend to stop generating
+                        await pieces.aclose()
+                outcome = "ok"
+                return
+        except GeneratorExit:
+            outcome = "stopped"
+            raise
+        finally:
+            self._record_request("stream", outcome, started, tried, first_token_at)
+    
+    @staticmethod
+    def _record_request(mode, outcome, started, tried, first_token_at=None):
+        ended = time.perf_counter()
+        LLM_REQUEST_SECONDS.observe(ended - started, labels=(mode, outcome))
+        trace = current_trace.get()
+        if trace is None:
+            return
+        if first_token_at is None:
+            trace.add_span("llm_request", started, ended, attempts=len(tried), outcome=outcome)
+        else:
+            # Prompt processing up to the first token, then decoding the rest
+            trace.add_span("llm_prefill", started, first_token_at, attempts=len(tried))
+            trace.add_span("llm_generate", first_token_at, ended, outcome=outcome)
+    
+    @staticmethod
+    async def _first_piece(pieces):
+        """Wait for the first piece of a stream; returns (stream, piece), piece is None for an empty stream"""
+        try:
+            return pieces, await pieces.__anext__()
+        except StopAsyncIteration:
+            return pieces, None
+        except BaseException:
+            await pieces.aclose()
+            raise
+    
+    async def _stream_on(self, backend, payload):
+        started = time.monotonic()
+        first_token = True
+        tokens = 0
+        trial = backend.start()
+        try:
+            # No overall deadline for streams, the read timeout still catches a stalled backend
+            timeout = aiohttp.ClientTimeout(
+                total=None,
+                connect=LM_STUDIO_CONNECT_TIMEOUT,
+                sock_read=LM_STUDIO_READ_TIMEOUT
+            )
+            async with self._get_session().post(backend.url, json=payload, timeout=timeout) as response:
+                llm_log.debug("Received response with status code: %d from %s", response.status, backend.url)
+                
+                if response.status != 200:
+                    raise LLMError(
+                        f"Error: Failed to contact LM Studio API. Status code: {response.status}",
+                        retryable=response.status >= 500
+                    )
+                
+                async for raw_line in response.content:
+                    line = raw_line.decode("utf-8", errors="replace").strip()
+                    # Every SSE event we care about is a single "data: {...}" line
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    
+                    chunk = json.loads(data)
+                    if not chunk.get("choices"):
+                        continue
+                    content = chunk["choices"][0].get("delta", {}).get("content")
+                    if content:
+                        if first_token:
+                            # Time to first token is what chat feels, so that's the latency we balance on
+                            backend.record_success(first_token=time.monotonic() - started)
+                            first_token = False
+                        # LM Studio streams one token per delta
+                        tokens += 1
+                        yield content
+        except LLMError as e:
+            llm_log.warning("%s", e)
+            if e.retryable:
+                backend.record_failure()
+            raise
+        except aiohttp.ClientError as e:
+            backend.record_failure()
+            raise self._error(f"Network error when contacting LM Studio API: {str(e)}", retryable=True)
+        except asyncio.TimeoutError:
+            backend.record_failure()
+            raise self._error("Network error when contacting LM Studio API: request timed out", retryable=True)
+        except json.JSONDecodeError as e:
+            raise self._error(f"Failed to parse LM Studio stream chunk as JSON: {str(e)}")
+        except Exception as e:
+            raise self._error(f"Unexpected error when calling LM Studio API: {str(e)}")
+        finally:
+            backend.finish(trial)
+            LLM_TOKENS_GENERATED.inc(tokens)
+    
+    def _payload(self, messages, temperature, max_tokens, model, stream):
+        reused, total = self.prefix_cache.observe(messages)
+        llm_log.debug("Prompt prefix shared with a recent request: %d/%d tokens", reused, total)
+        payload = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": stream
+        }
+        if LM_STUDIO_CACHE_HINTS:
+            # llama.cpp-based servers keep the KV cache of the matching prefix; others ignore it
+            payload["cache_prompt"] = True
+        return payload
+    
+    @staticmethod
+    def _error(error_msg, retryable=False):
+        llm_log.warning("%s", error_msg)
+        return LLMError(error_msg, retryable=retryable)
+
+# ---------------------------
+# Context budgeting
+# ---------------------------
+# Camel-case words, caps runs, digit groups, punctuation and single non-ASCII characters
+TOKEN_PIECE_RE = re.compile(r"[A-Z]{2,}(?![a-z])|[A-Z]?[a-z]+|[A-Z]|\d{1,3}|\s+|[\x21-\x7e]|[^\x00-\x7f]")
+
+class HeuristicTokenizer:
+    """Dependency-free token estimate that stays close to BPE counts for chat text.
+    
+    Emotes like PogChamp or KEKW split into several tokens, and non-Latin scripts and
+    emoji cost roughly a token per two UTF-8 bytes, which a flat chars-per-token
+    ratio gets badly wrong.
+    """
+    name = "heuristic"
+    
+    def count(self, text):
+        tokens = 0
+        for piece in TOKEN_PIECE_RE.findall(text):
+            first = piece[0]
+            if first.isspace():
+                continue  # Spaces merge into the following token
+            if not first.isascii():
+                tokens += (len(piece.encode("utf-8")) + 1) // 2
+            elif first.isupper() and len(piece) > 1 and piece.isupper():
+                tokens += (len(piece) + 1) // 2
+            elif first.isalpha():
+                tokens += 1 + (len(piece) - 1) // 8
+            else:
+                tokens += 1
+        return tokens
+
+class TiktokenTokenizer:
+    name = "tiktoken"
+    
+    def __init__(self, encoding="cl100k_base"):
+        self._encoding = tiktoken.get_encoding(encoding)
+    
+    def count(self, text):
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+def make_tokenizer(kind=CONTEXT_TOKENIZER):
+    if kind == "tiktoken" or (kind == "auto" and tiktoken is not None):
+        if tiktoken is None:
+            llm_log.warning("tiktoken is not installed, falling back to the heuristic tokenizer")
+            return HeuristicTokenizer()
+        return TiktokenTokenizer()
+    return HeuristicTokenizer()
+
+active_tokenizer = make_tokenizer()
+
+@functools.lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)
+def count_tokens(text):
+    return active_tokenizer.count(text)
+
+def set_tokenizer(tokenizer):
+    """Swap in any object with a count(text) method, e.g. the model's own tokenizer"""
+    global active_tokenizer
+    active_tokenizer = tokenizer
+    count_tokens.cache_clear()
+    # Stored per-message counts came from the old tokenizer
+    for conversation in all_conversations():
+        conversation.recount()
+
+class ChatMessage:
+    """One history entry with its token cost counted once, when it's created"""
+    __slots__ = ("role", "content", "tokens")
+    
+    def __init__(self, role, content):
+        self.role = role
+        self.content = content
+        self.tokens = ContextBudgeter.message_tokens(content)
+    
+    def to_dict(self):
+        return {"role": self.role, "content": self.content}
+
+class ConversationBuffer:
+    """Conversation history with O(1) append and evict-oldest, plus running token and character totals.
+    
+    With compaction on, evicted turns wait in pending until they are folded into the
+    rolling summary, which is sent ahead of the remaining history.
+    """
+    __slots__ = ("_messages", "token_count", "char_count", "summary", "pending", "compacting", "key")
+    
+    def __init__(self, messages=(), key=None):
+        self.key = key  # Store key, None for conversations that aren't persisted
+        self._messages = collections.deque()
+        self.token_count = 0
+        self.char_count = 0
+        self.summary = None
+        self.pending = None
+        self.compacting = False
+        for msg in messages:
+            self.append(msg["role"], msg["content"])
+    
+    def __len__(self):
+        return len(self._messages)
+    
+    def __iter__(self):
+        return iter(self._messages)
+    
+    def append(self, role, content):
+        msg = ChatMessage(role, content)
+        self._messages.append(msg)
+        self.token_count += msg.tokens
+        self.char_count += len(content)
+        return msg
+    
+    def last(self):
+        return self._messages[-1] if self._messages else None
+    
+    def evict_oldest_pair(self):
+        """Drop the oldest user/assistant exchange and return the removed messages"""
+        removed = []
+        for _ in range(min(2, len(self._messages))):
+            msg = self._messages.popleft()
+            self.token_count -= msg.tokens
+            self.char_count -= len(msg.content)
+            removed.append(msg)
+        return removed
+    
+    def set_summary(self, text):
+        if self.summary is not None:
+            self.token_count -= self.summary.tokens
+            self.char_count -= len(self.summary.content)
+        self.summary = ChatMessage("system", SUMMARY_LABEL + text)
+        self.token_count += self.summary.tokens
+        self.char_count += len(self.summary.content)
+    
+    def clear(self):
+        self._messages.clear()
+        self.token_count = 0
+        self.char_count = 0
+        self.summary = None
+        self.pending = None
+    
+    def recount(self):
+        self.token_count = 0
+        for msg in self._messages:
+            msg.tokens = ContextBudgeter.message_tokens(msg.content)
+            self.token_count += msg.tokens
+        if self.summary is not None:
+            self.summary.tokens = ContextBudgeter.message_tokens(self.summary.content)
+            self.token_count += self.summary.tokens
+    
+    def to_messages(self):
+        """The history in the OpenAI chat "messages" format, rolling summary first"""
+        messages = [msg.to_dict() for msg in self._messages]
+        if self.summary is not None:
+            messages.insert(0, self.summary.to_dict())
+        return messages
+
+# Rough per-message memory cost on top of the text itself (record + str headers)
+MESSAGE_OVERHEAD_BYTES = sys.getsizeof(ChatMessage.__new__(ChatMessage)) + 2 * sys.getsizeof("")
+
+class ConversationManager:
+    """Per-user conversations with an LRU cap and an idle TTL.
+    
+    The dict is kept in last-used order, so it doubles as the time index: sweeping only
+    looks at the oldest entries and stops at the first one that's still fresh. The web
+    app reads stats from another thread, hence the lock.
+    """
+    
+    def __init__(self, max_users=CONVERSATION_MAX_USERS, idle_ttl=CONVERSATION_IDLE_TTL):
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl
+        self._conversations = collections.OrderedDict()  # user id -> (last_used, ConversationBuffer)
+        self._lock = threading.Lock()
+        self.evicted_idle = 0
+        self.evicted_lru = 0
+    
+    async def get(self, user_id):
+        """Return the user's conversation, restoring or creating it if needed, and mark it as just used"""
+        with self._lock:
+            conversation = self._touch(user_id)
+        if conversation is not None:
+            return conversation
+        # Users are restored on their first mention, so startup cost doesn't grow with the store.
+        # The query runs in a thread and outside the lock, so it can't stall the event loop.
+        restored = await conversation_store.load_async(user_id) if conversation_store else None
+        with self._lock:
+            # Another mention of the same user may have got here first
+            conversation = self._touch(user_id)
+            if conversation is None:
+                conversation = restored if restored is not None else ConversationBuffer(key=user_id)
+                self._conversations[user_id] = (time.monotonic(), conversation)
+                while len(self._conversations) > self.max_users:
+                    self._conversations.popitem(last=False)
+                    self.evicted_lru += 1
+            return conversation
+    
+    def _touch(self, user_id):
+        """The user's conversation moved to the most recently used end, or None if it isn't held"""
+        now = time.monotonic()
+        self._sweep(now)
+        entry = self._conversations.pop(user_id, None)
+        if entry is None:
+            return None
+        self._conversations[user_id] = (now, entry[1])
+        return entry[1]
+    
+    def __contains__(self, user_id):
+        return user_id in self._conversations
+    
+    def __len__(self):
+        return len(self._conversations)
+    
+    def values(self):
+        with self._lock:
+            return [conversation for _, conversation in self._conversations.values()]
+    
+    def sweep(self):
+        with self._lock:
+            return self._sweep(time.monotonic())
+    
+    def _sweep(self, now):
+        cutoff = now - self.idle_ttl
+        evicted = 0
+        while self._conversations:
+            last_used, _ = next(iter(self._conversations.values()))
+            if last_used > cutoff:
+                break
+            self._conversations.popitem(last=False)
+            evicted += 1
+        self.evicted_idle += evicted
+        return evicted
+    
+    def stats(self):
+        conversations = self.values()
+        messages = sum(len(conversation) for conversation in conversations)
+        chars = sum(conversation.char_count for conversation in conversations)
+        return {
+            "users": len(conversations),
+            "max_users": self.max_users,
+            "idle_ttl": self.idle_ttl,
+            "evicted_idle": self.evicted_idle,
+            "evicted_lru": self.evicted_lru,
+            "messages": messages,
+            "resident_bytes_estimate": chars + messages * MESSAGE_OVERHEAD_BYTES,
+        }
+
+def all_conversations():
+    yield global_conversation
+    for channel in list(channel_contexts.values()):
+        if channel._global_conversation is not None:
+            yield channel._global_conversation
+    yield from user_conversations.values()
+
+class ContextBudgeter:
+    """Trims the oldest exchanges of a conversation so it fits the model's context window.
+    
+    Buffers keep their own running token totals, so checking the budget never rescans
+    the history.
+    """
+    
+    def __init__(self, num_ctx=DEFAULT_NUM_CTX, max_tokens=DEFAULT_MAX_TOKENS):
+        self.num_ctx = num_ctx
+        self.max_tokens = max_tokens
+        self.evicted_pairs = 0
+    
+    @staticmethod
+    def message_tokens(content):
+        return count_tokens(content) + CONTEXT_MESSAGE_OVERHEAD_TOKENS
+    
+    def history_limit(self, system_prompt, max_tokens=None):
+        """Tokens left for history and the new prompt once the system prompt and reply are reserved"""
+        if max_tokens is None:
+            max_tokens = self.max_tokens
+        return self.num_ctx - max_tokens - self.message_tokens(system_prompt) - CONTEXT_SAFETY_TOKENS
+    
+    def fit(self, conversation, system_prompt, reserve=0, keep=2, max_tokens=None):
+        """Evict the oldest exchanges until history plus reserve tokens fits; keeps at least keep messages.
+        
+        Room is left for a completion of max_tokens, DEFAULT_MAX_TOKENS unless given.
+        
+        In prefix-cache mode a trim frees a whole block of the budget at once. The front of
+        the history then stays unchanged for the next several requests instead of shifting
+        by one exchange every time, so the backend can reuse its cached prefix.
+        """
+        history_limit = self.history_limit(system_prompt, max_tokens)
+        limit = history_limit - reserve
+        if conversation.token_count <= limit:
+            return 0
+        if PROMPT_PREFIX_CACHE_MODE:
+            limit -= int(history_limit * PREFIX_EVICT_BLOCK_FRACTION)
+        evicted = 0
+        while conversation.token_count > limit and len(conversation) > keep:
+            removed = conversation.evict_oldest_pair()
+            if CONVERSATION_COMPACTION_ENABLED:
+                # Kept aside for the next summary instead of being forgotten
+                if conversation.pending is None:
+                    conversation.pending = []
+                conversation.pending.extend(removed)
+            evicted += 1
+        self.evicted_pairs += evicted
+        return evicted
+    
+    def stats(self):
+        conversations = list(all_conversations())
+        return {
+            "tokenizer": active_tokenizer.name,
+            "conversations": len(conversations),
+            "total_tokens": sum(conversation.token_count for conversation in conversations),
+            "evicted_pairs": self.evicted_pairs,
+            "token_cache": count_tokens.cache_info()._asdict(),
+        }
+
+context_budget = ContextBudgeter()
+global_conversation = ConversationBuffer(key=GLOBAL_CONVERSATION_KEY)
+user_conversations = ConversationManager()
+
+# ---------------------------
+# Durable conversation store
+# ---------------------------
+class ConversationStore:
+    """Persists conversation contexts to SQLite so they survive crashes and restarts.
+    
+    Nothing is written on the hot path: changed conversations are only marked dirty and
+    a background task snapshots them on the event loop and writes them in one transaction
+    from a worker thread. Each row holds a whole (already trimmed) conversation, so a
+    restore is a single primary-key lookup. Reads go through their own connection, so
+    they don't wait for a flush's transaction (WAL lets them see the last commit).
+    """
+    
+    def __init__(self, path=CONVERSATION_DB_FILE, flush_interval=CONVERSATION_FLUSH_INTERVAL,
+                 retention_days=CONVERSATION_RETENTION_DAYS):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.retention = retention_days * 24 * 60 * 60
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")  # WAL keeps this crash-safe, only the last commit can be lost on power failure
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "key TEXT PRIMARY KEY, messages TEXT NOT NULL, summary TEXT, updated REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated)")
+        self._db_lock = threading.Lock()
+        self._reader = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._read_lock = threading.Lock()
+        self._dirty = {}  # key -> ConversationBuffer changed since the last flush
+        self._writing = {}  # key -> ConversationBuffer of the flush in progress
+        self._flush_task = None
+        self.restored = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.write_errors = 0
+        self.last_flush_seconds = 0.0
+        self.prune()
+    
+    def load(self, key):
+        """Return the stored conversation for key, or None if there isn't one"""
+        with self._read_lock:
+            row = self._reader.execute(
+                "SELECT messages, summary FROM conversations WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        conversation = ConversationBuffer(json.loads(row[0]), key=key)
+        if row[1]:
+            conversation.set_summary(row[1])
+        self.restored += 1
+        return conversation
+    
+    async def load_async(self, key):
+        """load() from a worker thread, for the event loop"""
+        # Changes that aren't committed yet are newer than the row
+        for pending in (self._dirty, self._writing):
+            if key in pending:
+                return pending[key]
+        return await asyncio.to_thread(self.load, key)
+    
+    def mark_dirty(self, conversation):
+        if conversation.key is not None:
+            self._dirty[conversation.key] = conversation
+    
+    def start(self):
+        """Start the background flusher on the running event loop"""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+    
+    async def stop(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+    
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+    
+    async def flush(self):
+        dirty, rows = self._snapshot()
+        if rows:
+            self._writing = dirty
+            try:
+                written = await asyncio.to_thread(self._write, rows)
+            finally:
+                self._writing = {}
+            if not written:
+                self._requeue(dirty)
+    
+    def flush_now(self):
+        """Synchronous flush, for shutdown when no event loop is running anymore"""
+        dirty, rows = self._snapshot()
+        if rows and not self._write(rows):
+            self._requeue(dirty)
+    
+    def _snapshot(self):
+        # Runs on the event loop, so the buffers can't change while they're serialized
+        dirty, self._dirty = self._dirty, {}
+        now = time.time()
+        rows = []
+        for key, conversation in dirty.items():
+            summary = conversation.summary.content[len(SUMMARY_LABEL):] if conversation.summary else None
+            rows.append((key, json.dumps([msg.to_dict() for msg in conversation]), summary, now))
+        return dirty, rows
+    
+    def _requeue(self, dirty):
+        # Retried with the next flush; anything marked dirty since the snapshot is newer and stays
+        for key, conversation in dirty.items():
+            self._dirty.setdefault(key, conversation)
+    
+    def _write(self, rows):
+        """Write rows in one transaction, returns whether it committed"""
+        started = time.perf_counter()
+        try:
+            with self._db_lock:
+                self._db.execute("BEGIN")
+                self._db.executemany(
+                    "INSERT INTO conversations (key, messages, summary, updated) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET messages = excluded.messages, "
+                    "summary = excluded.summary, updated = excluded.updated",
+                    rows
+                )
+                self._db.execute("COMMIT")
+        except sqlite3.Error as e:
+            self.write_errors += 1
+            store_log.error("Error saving %d conversations, retrying with the next flush: %s", len(rows), e)
+            with self._db_lock:
+                if self._db.in_transaction:
+                    self._db.execute("ROLLBACK")
+            return False
+        self.flushes += 1
+        self.rows_written += len(rows)
+        self.last_flush_seconds = time.perf_counter() - started
+        return True
+    
+    def prune(self):
+        """Delete stored conversations nobody has touched within the retention period"""
+        with self._db_lock:
+            deleted = self._db.execute(
+                "DELETE FROM conversations WHERE updated < ?", (time.time() - self.retention,)
+            ).rowcount
+        if deleted:
+            store_log.info("Pruned %d stored conversations older than %d days", deleted, self.retention // 86400)
+        return deleted
+    
+    def stats(self):
+        with self._read_lock:
+            stored = self._reader.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+        return {
+            "path": self.path,
+            "stored": stored,
+            "dirty": len(self._dirty),
+            "restored": self.restored,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "write_errors": self.write_errors,
+            "last_flush_seconds": self.last_flush_seconds,
+        }
+
+conversation_store = ConversationStore() if CONVERSATION_STORE_ENABLED else None
+if conversation_store:
+    # The shared context is the only one loaded eagerly
+    restored = conversation_store.load(GLOBAL_CONVERSATION_KEY)
+    if restored is not None:
+        global_conversation = restored
+    atexit.register(conversation_store.flush_now)
+
+# ---------------------------
+# Channels
+# ---------------------------
+class ChannelContext:
+    """Settings, shared context and load of one channel the bot serves.
+
+    A channel can override the whitelist and system prompt with its own files in
+    CHANNEL_SETTINGS_DIR/<channel>/, otherwise the bot-wide ones apply. Contexts are
+    namespaced per channel; STREAMER_CHANNEL keeps the plain keys, so conversations
+    stored before there were several channels still belong to it.
+    """
 
-# Hardcoded safety rule that cannot be edited from the portal
-SAFETY_RULE = "No racism, sexism, or any discriminatory garbage. "
+    def __init__(self, name):
+        self.name = name
+        self.is_main = name == STREAMER_CHANNEL.lstrip("#").lower()
+        self.shard = 0
+        self.whitelist = None  # None: the bot-wide whitelist applies
+        self.custom_prompt = None  # None: the bot-wide system prompt applies
+        self._global_conversation = None
+        self.messages = 0
+        self.mentions = 0
+        self.replies = 0
+        self.in_flight = 0
+        self._reply_seconds = collections.deque(maxlen=500)
+        self.reload()
 
-# Combine the safety rule with the user-editable part of the prompt
-system_prompt = SAFETY_RULE + system_prompt
+    def reload(self):
+        """Re-read the channel's settings files, called whenever the bot (re)starts"""
+        folder = os.path.join(CHANNEL_SETTINGS_DIR, self.name)
+        whitelist_file = os.path.join(folder, WHITELIST_FILE)
+        prompt_file = os.path.join(folder, SYSTEM_PROMPT_FILE)
+        self.whitelist = None
+        self.custom_prompt = None
+        if os.path.exists(whitelist_file):
+            with open(whitelist_file, "r", encoding="utf-8") as f:
+                self.whitelist = set(line.strip().lower() for line in f if line.strip())
+        if os.path.exists(prompt_file):
+            with open(prompt_file, "r", encoding="utf-8") as f:
+                # The safety rule applies to every channel
+                self.custom_prompt = SAFETY_RULE + (f.read() or "You are a helpful assistant.")
 
-# Global variables
-whitelist = set()
-should_restart = False  # Flag to indicate if the bot should restart
+    @property
+    def system_prompt(self):
+        return self.custom_prompt or system_prompt
 
-# Functions for persistent whitelist
-def load_whitelist():
-    global whitelist
-    if os.path.exists(WHITELIST_FILE):
-        with open(WHITELIST_FILE, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-        whitelist = set(line.strip().lower() for line in lines if line.strip())
-    return whitelist
+    def allows(self, user_id):
+        return user_id in (whitelist if self.whitelist is None else self.whitelist)
 
-def save_whitelist():
-    with open(WHITELIST_FILE, "w", encoding="utf-8") as f:
-        for user in sorted(whitelist):
-            f.write(f"{user}\n")
-    print(f"Whitelist saved with {len(whitelist)} users.")
+    def conversation_key(self, user_id):
+        # Twitch logins can't contain "#", so these can't clash with a main channel key
+        return user_id if self.is_main else f"#{self.name}/{user_id}"
 
-# Load the whitelist at startup
-load_whitelist()
+    async def load_global_conversation(self):
+        if self.is_main:
+            return global_conversation
+        if self._global_conversation is None:
+            key = f"{GLOBAL_CONVERSATION_KEY}#{self.name}"
+            restored = await conversation_store.load_async(key) if conversation_store else None
+            if self._global_conversation is None:
+                self._global_conversation = restored if restored is not None else ConversationBuffer(key=key)
+        return self._global_conversation
 
-# Global whitelist for allowed Twitch users (stored as lower-case)
-whitelist = load_whitelist()
+    def record_reply(self, seconds):
+        self.replies += 1
+        self._reply_seconds.append(seconds)
 
-# Functions for moderator management
-def load_moderators():
-    moderators = []
-    if os.path.exists(MODERATORS_FILE):
-        with open(MODERATORS_FILE, "r", encoding="utf-8") as f:
-            moderators = [line.strip().lower() for line in f if line.strip()]
-    return moderators
+    def stats(self):
+        reply_seconds = list(self._reply_seconds)
+        return {
+            "shard": self.shard,
+            "messages": self.messages,
+            "mentions": self.mentions,
+            "replies": self.replies,
+            "in_flight": self.in_flight,
+            "reply_p50": percentile(reply_seconds, 0.5),
+            "reply_p95": percentile(reply_seconds, 0.95),
+            "own_whitelist": self.whitelist is not None,
+            "own_system_prompt": self.custom_prompt is not None,
+        }
 
-def save_moderators(moderators):
-    with open(MODERATORS_FILE, "w", encoding="utf-8") as f:
-        for user in moderators:
-            f.write(f"{user}\n")
-    print(f"Moderators list saved with {len(moderators)} users.")
+channel_contexts = {}  # channel name -> ChannelContext
 
-# Load moderators from file on startup
-moderators = load_moderators()
+def get_channel(name):
+    name = name.lstrip("#").lower()
+    channel = channel_contexts.get(name)
+    if channel is None:
+        channel = channel_contexts[name] = ChannelContext(name)
+    return channel
 
-# Create an empty set for active sessions, to track who's logged in
-active_sessions = {}
+def bot_channels():
+    """Every channel the bot serves, STREAMER_CHANNEL first"""
+    names = []
+    for name in [STREAMER_CHANNEL] + EXTRA_CHANNELS:
+        name = name.strip().lstrip("#").lower()
+        if name and name not in names:
+            names.append(name)
+    return names
 
-# ---------------------------
-# Twitch IRC WebSocket for sending messages
-# ---------------------------
-twitch_ws_app = None
-ws_lock = threading.Lock()
-last_activity = time.time()
-reconnect_attempts = 0
-
-def send_message(ws_app, message):
-    global last_activity
-    with ws_lock:
-        if ws_app and ws_app.sock and ws_app.sock.connected:
-            try:
-                ws_app.send(f"PRIVMSG #{STREAMER_CHANNEL} :{message}")
-                last_activity = time.time()
-                return True
-            except Exception as e:
-                print(f"Error sending message: {str(e)}")
-                reconnect_websocket()
-                return False
-        else:
-            print("WebSocket not connected, attempting reconnect...")
-            reconnect_websocket()
-            return False
+def assign_shards(channels, shards=CHAT_SHARDS, overrides=CHANNEL_SHARD_OVERRIDES):
+    """Split channels into one list per shard.
 
-def on_open(ws):
-    global twitch_ws_app, reconnect_attempts
-    with ws_lock:
-        twitch_ws_app = ws
-    token = TWITCH_OAUTH_TOKEN if TWITCH_OAUTH_TOKEN.startswith("oauth:") else f"oauth:{TWITCH_OAUTH_TOKEN}"
-    ws.send(f"PASS {token}")
-    ws.send(f"NICK {TWITCH_USERNAME}")
-    ws.send(f"JOIN #{STREAMER_CHANNEL}")
-    reconnect_attempts = 0
-    print("[Twitch] WebSocket connected successfully")
-    threading.Thread(target=keep_alive, daemon=True).start()
-
-def on_error(ws, error):
-    print(f"WebSocket error: {str(error)}")
-
-def on_close(ws, close_status_code, close_msg):
-    print(f"WebSocket closed (code: {close_status_code}, message: {close_msg})")
-    reconnect_websocket()
-
-def reconnect_websocket():
-    global reconnect_attempts
-    with ws_lock:
-        global twitch_ws_app
-        if twitch_ws_app:
-            try:
-                twitch_ws_app.close()
-            except:
-                pass
-        reconnect_attempts += 1
-        delay = min(5 + (2 ** reconnect_attempts), 30)
-        print(f"Attempting reconnect in {delay} seconds...")
-        time.sleep(delay)
-        connect_to_twitch_ws()
-
-def keep_alive():
-    while True:
-        time.sleep(60)
-        with ws_lock:
-            if twitch_ws_app and twitch_ws_app.sock and twitch_ws_app.sock.connected:
-                try:
-                    if time.time() - last_activity > 240:
-                        twitch_ws_app.send("PING :tmi.twitch.tv")
-                        print("Sent keep-alive PING")
-                except:
-                    reconnect_websocket()
-
-def connect_to_twitch_ws():
-    global twitch_ws_app
-    ws = websocket.WebSocketApp(
-        "wss://irc-ws.chat.twitch.tv:443",
-        on_open=on_open,
-        on_error=on_error,
-        on_close=on_close
-    )
-    ws.run_forever()
+    Pinned channels go to their shard from CHANNEL_SHARD_OVERRIDES and the rest are
+    spread over the unpinned shards by a hash of their name, so a pinned hot channel
+    gets its shard to itself and adding a channel doesn't move the others.
+    """
+    shards = max(1, shards)
+    pinned = {name.lstrip("#").lower(): index % shards for name, index in overrides.items()}
+    free = [index for index in range(shards) if index not in pinned.values()] or list(range(shards))
+    assignment = [[] for _ in range(shards)]
+    for name in channels:
+        index = pinned.get(name)
+        if index is None:
+            index = free[zlib.crc32(name.encode("utf-8")) % len(free)]
+        assignment[index].append(name)
+    return assignment
 
 # ---------------------------
-# Twitch Chat Bot using TwitchIO
+# LLM request scheduler
 # ---------------------------
-class TwitchBot(commands.Bot):
-    def __init__(self):
-        super().__init__(
-            token=f"oauth:{TWITCH_OAUTH_TOKEN}",
-            prefix="!",
-            initial_channels=[STREAMER_CHANNEL]
-        )
-        
-    async def event_ready(self):
-        print(f"Logged in as | {self.nick}")
-        await self.join_channels([STREAMER_CHANNEL])
-        await asyncio.sleep(1)
-        print("TwitchIO connected channels:")
-        for channel in self.connected_channels:
-            print(f" - {channel.name}")
+class LLMQueueFullError(Exception):
+    pass
+
+class LLMScheduler:
+    """Caps concurrent LLM generations and hands free slots to waiting users round-robin.
+    
+    Background jobs (e.g. conversation summaries) wait in their own lane and only get a
+    slot when no chatter is waiting.
+    
+    With batching on, requests don't start the moment a slot is free. The first one
+    opens a short window and everything that arrives in it is released together, so a
+    burst of mentions lands on llama.cpp-style backends as one parallel decode batch
+    instead of trickling in one by one. Slots that free up are held too until the window
+    closes or a full batch can go. A batch is at most min(batch_max_size, max_concurrency)
+    requests, so batching only does something with max_concurrency raised above the
+    default.
+    """
+    
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, max_queue=LLM_MAX_QUEUE,
+                 max_queue_per_user=LLM_MAX_QUEUE_PER_USER, max_background_queue=LLM_MAX_BACKGROUND_QUEUE,
+                 batch_window=LLM_BATCH_WINDOW_MS / 1000 if LLM_BATCHING_ENABLED else 0,
+                 batch_max_size=LLM_BATCH_MAX_SIZE):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.max_background_queue = max_background_queue
+        self.batch_window = batch_window
+        self.batch_max_size = batch_max_size
+        self._batch_timer = None
+        self.batches = 0
+        self.batched_requests = 0
+        self._batch_sizes = collections.deque(maxlen=200)
+        # user_id -> deque of waiting futures; the dict order is the round-robin order
+        self._waiting = collections.OrderedDict()
+        self._queued = 0
+        self._background = collections.deque()
+        self._running = 0
         
-    async def event_message(self, message):
-        global user_conversations, global_conversation
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self._wait_times = collections.deque(maxlen=500)
+        self._service_times = collections.deque(maxlen=500)
+    
+    async def run(self, user_id, job, background=False):
+        """Await job() once a generation slot is free; raises LLMQueueFullError if the queue is full"""
+        self.submitted += 1
+        enqueued_at = time.monotonic()
         
-        channel_name = getattr(message.channel, 'name', 'N/A')
-        author_name = message.author.name if message.author else "None"
-        print(f"Received message from {author_name} in channel: {channel_name}")
+        if (self._running < self.max_concurrency and self._queued == 0 and not self._background
+                and not self.batch_window):
+            self._running += 1
+        else:
+            slot = asyncio.get_running_loop().create_future()
+            if background:
+                if len(self._background) >= self.max_background_queue:
+                    self.rejected += 1
+                    raise LLMQueueFullError(f"Background queue is full ({len(self._background)} waiting)")
+                self._background.append(slot)
+            else:
+                user_queue = self._waiting.get(user_id)
+                if self._queued >= self.max_queue:
+                    self.rejected += 1
+                    raise LLMQueueFullError(f"LLM queue is full ({self._queued} waiting)")
+                if user_queue is not None and len(user_queue) >= self.max_queue_per_user:
+                    self.rejected += 1
+                    raise LLMQueueFullError(f"{user_id} already has {len(user_queue)} requests waiting")
+                
+                if user_queue is None:
+                    user_queue = self._waiting[user_id] = collections.deque()
+                user_queue.append(slot)
+                self._queued += 1
+            if self.batch_window:
+                self._schedule_batch()
+            try:
+                await slot
+            except asyncio.CancelledError:
+                if slot.done() and not slot.cancelled():
+                    # The slot was handed over just as we got cancelled, pass it on
+                    self._release()
+                raise
         
-        if not message.author or message.author.name.lower() == TWITCH_USERNAME.lower():
+        started_at = time.monotonic()
+        self._wait_times.append(started_at - enqueued_at)
+        LLM_QUEUE_WAIT_SECONDS.observe(started_at - enqueued_at, labels=("background" if background else "chat",))
+        try:
+            return await job()
+        finally:
+            self._service_times.append(time.monotonic() - started_at)
+            self.completed += 1
+            self._release()
+    
+    def _release(self):
+        self._running -= 1
+        if self.batch_window:
+            self._schedule_batch()
             return
+        while self._running < self.max_concurrency and self._dispatch_next():
+            pass
+    
+    def _dispatch_next(self):
+        """Hand a slot to the next waiting user in round-robin order, background work last.
         
-        if TWITCH_USERNAME.lower() in message.content.lower():
-            if message.author.name.lower() not in whitelist:
-                print(f"User {message.author.name} not whitelisted. Ignoring.")
-                return
-            
-            # Check if the message includes the (global) tag
-            is_global = "(global)" in message.content.lower()
-            
-            pattern = r'(?i)@?\b{}\b'.format(re.escape(TWITCH_USERNAME))
-            # Remove the bot's name and the (global) tag if present
-            user_prompt = re.sub(pattern, '', message.content).strip()
-            user_prompt = re.sub(r'\(global\)', '', user_prompt, flags=re.IGNORECASE).strip() or "Hello"
-            
-            # Choose the appropriate context
-            if is_global:
-                print(f"Using global context for user {author_name}")
-                message_history = global_conversation
-            else:
-                # Get or initialize user's conversation context
-                user_id = message.author.name.lower()
-                if user_id not in user_conversations:
-                    user_conversations[user_id] = []
-                
-                message_history = user_conversations[user_id]
-                print(f"Using individual context for user {author_name}")
-            
-            ai_response = await asyncio.to_thread(
-                call_lm_studio,
-                prompt=user_prompt,
-                temperature=DEFAULT_TEMPERATURE,
-                max_tokens=DEFAULT_MAX_TOKENS,
-                system_prompt=system_prompt,
-                model=LM_STUDIO_MODEL,
-                num_ctx=DEFAULT_NUM_CTX,
-                message_history=message_history
-            )
-            
-            # Update the appropriate conversation history with this exchange
-            # First add the user message if not already in history
-            if not message_history or message_history[-1]["role"] != "user" or message_history[-1]["content"] != user_prompt:
-                message_history.append({"role": "user", "content": user_prompt})
-            
-            # Then add the assistant's response
-            message_history.append({"role": "assistant", "content": ai_response})
-            
-            # Prevent context from growing too large - based on rough character count estimate
-            # A simple heuristic: if total characters > 75% of context window, remove oldest messages
-            total_chars = sum(len(msg["content"]) for msg in message_history)
-            char_limit = DEFAULT_NUM_CTX * 3  # Rough estimate: 3 chars per token
-            
-            while total_chars > char_limit * 0.75 and len(message_history) > 2:
-                # Remove oldest message pair (user and assistant)
-                if len(message_history) >= 2:
-                    removed1 = message_history.pop(0)
-                    total_chars -= len(removed1["content"])
-                    
-                    if message_history:  # Check if there are still messages
-                        removed2 = message_history.pop(0)
-                        total_chars -= len(removed2["content"])
-            
-            # Save the updated history to the appropriate context
-            if is_global:
-                global_conversation = message_history
-                print(f"Global context updated, now has {len(global_conversation)} messages")
+        Returns False when nobody is waiting.
+        """
+        while self._waiting or self._background:
+            if self._waiting:
+                user_id, user_queue = next(iter(self._waiting.items()))
+                slot = user_queue.popleft()
+                self._queued -= 1
+                if user_queue:
+                    self._waiting.move_to_end(user_id)
+                else:
+                    del self._waiting[user_id]
             else:
-                user_conversations[user_id] = message_history
-                print(f"User {user_id} context updated, now has {len(message_history)} messages")
-            
-            reply = f"@{message.author.name} {ai_response}"
-            await self.handle_reply(reply)
-        
-        await self.handle_commands(message)
+                slot = self._background.popleft()
+            if slot.cancelled():
+                continue
+            self._running += 1
+            slot.set_result(None)
+            return True
+        return False
+    
+    @property
+    def batch_size(self):
+        """Requests a full batch holds, no more than can run at once"""
+        return min(self.batch_max_size, self.max_concurrency)
+    
+    def _schedule_batch(self):
+        # Release right away once there are free slots and requests for a full batch,
+        # otherwise hold the slots until the window closes
+        free = self.max_concurrency - self._running
+        waiting = self._queued + len(self._background)
+        if free <= 0 or waiting == 0:
+            return
+        if min(free, waiting) >= self.batch_size:
+            if self._batch_timer:
+                self._batch_timer.cancel()
+            self._release_batch()
+        elif self._batch_timer is None:
+            self._batch_timer = asyncio.get_running_loop().call_later(self.batch_window, self._release_batch)
+    
+    def _release_batch(self):
+        self._batch_timer = None
+        size = 0
+        while (size < self.batch_size and self._running < self.max_concurrency
+               and self._dispatch_next()):
+            size += 1
+        if size:
+            self.batches += 1
+            self.batched_requests += size
+            self._batch_sizes.append(size)
+        # Whatever didn't fit starts the next window
+        self._schedule_batch()
+    
+    def stats(self):
+        wait_times = list(self._wait_times)
+        service_times = list(self._service_times)
+        return {
+            "running": self._running,
+            "max_concurrency": self.max_concurrency,
+            "queue_depth": self._queued,
+            "queued_users": len(self._waiting),
+            "max_queue": self.max_queue,
+            "background_queue_depth": len(self._background),
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "wait_p50": percentile(wait_times, 0.5),
+            "wait_p95": percentile(wait_times, 0.95),
+            "wait_max": max(wait_times, default=0.0),
+            "service_p50": percentile(service_times, 0.5),
+            "service_p95": percentile(service_times, 0.95),
+            "service_max": max(service_times, default=0.0),
+            "batching": {
+                "enabled": bool(self.batch_window),
+                "window_ms": self.batch_window * 1000,
+                "max_size": self.batch_max_size,
+                "effective_size": self.batch_size,
+                "batches": self.batches,
+                "avg_batch_size": self.batched_requests / self.batches if self.batches else 0.0,
+                # Share of the available batch capacity that bursts actually filled
+                "occupancy": (sum(self._batch_sizes) / (len(self._batch_sizes) * self.batch_size)
+                              if self._batch_sizes else 0.0),
+            },
+        }
 
-    async def handle_reply(self, reply):
-        max_retries = 3
-        for attempt in range(max_retries):
-            success = send_message(twitch_ws_app, reply)
-            if success:
-                print(f"Sent reply via WebSocket: {reply}")
-                return
-            print(f"Send failed (attempt {attempt+1}/{max_retries})")
-            await asyncio.sleep(2 ** attempt)
-        print(f"Failed to send message after {max_retries} attempts")
+# ---------------------------
+# In-flight request coalescing
+# ---------------------------
+class InflightCoalescer:
+    """Lets identical requests that arrive while one is running wait for that one's result"""
+    
+    def __init__(self):
+        self._inflight = {}  # key -> future of the running job
+        self.leaders = 0
+        self.coalesced = 0
+    
+    async def run(self, key, job):
+        """Return (result, shared); shared is True when the result came from another caller's job"""
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            # Shielded so one waiter giving up doesn't cancel the result for everyone else
+            return await asyncio.shield(future), True
+        
+        self.leaders += 1
+        future = asyncio.get_running_loop().create_future()
+        # Mark failures as retrieved so asyncio doesn't complain when nobody else was waiting
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = future
+        try:
+            result = await job()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._inflight[key]
+    
+    def stats(self):
+        return {
+            "in_flight": len(self._inflight),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
 
-def call_lm_studio(prompt, temperature, max_tokens, system_prompt, model, num_ctx, message_history=None):
-    # Start with the system message
-    messages = [{"role": "system", "content": system_prompt}]
+# ---------------------------
+# Response cache
+# ---------------------------
+class ResponseCache:
+    """LRU + TTL cache of finished replies keyed on a hash of the full request context.
     
-    # Add conversation history if available
-    if message_history and len(message_history) > 0:
-        messages.extend(message_history)
+    Shared by the bot's event loop and the Flask thread (which clears it when the
+    system prompt changes), so every operation takes the lock.
+    """
     
-    # Add the current user message if not already included in history
-    if not message_history or message_history[-1]["role"] != "user" or message_history[-1]["content"] != prompt:
-        messages.append({"role": "user", "content": prompt})
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES, max_chars=RESPONSE_CACHE_MAX_CHARS, ttl=RESPONSE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()  # key -> (expires_at, response)
+        self._chars = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
     
-    payload = {
-        "model": model,
-        "messages": messages,
-        "temperature": temperature,
-        "max_tokens": max_tokens,
-        "stream": False
-    }
+    @staticmethod
+    def make_key(system_prompt, model, temperature, max_tokens, message_history, prompt):
+        hasher = hashlib.sha256()
+        hasher.update(json.dumps([system_prompt, model, temperature, max_tokens, prompt]).encode("utf-8"))
+        for msg in message_history or ():
+            hasher.update(json.dumps([msg.role, msg.content]).encode("utf-8"))
+        return hasher.hexdigest()
     
-    try:
-        print(f"Sending request to LM Studio API with {len(messages)} messages in context")
-        response = requests.post(LM_STUDIO_API_URL, json=payload, timeout=30)
-        print(f"Received response with status code: {response.status_code}")
-        
-        if response.status_code == 200:
-            data = response.json()
-            # Extract the message content from the LM Studio response format
-            if "choices" in data and len(data["choices"]) > 0:
-                content = data["choices"][0].get("message", {}).get("content", "")
-                if content:
-                    return content
-                else:
-                    return "Sorry, I received an empty response from the AI."
-            else:
-                return "Sorry, I couldn't understand the AI's response format."
-        else:
-            error_msg = f"Error: Failed to contact LM Studio API. Status code: {response.status_code}"
-            print(error_msg)
-            if response.content:
-                print(f"Response content: {response.content.decode('utf-8', errors='replace')}")
-            return error_msg
-    except requests.RequestException as e:
-        error_msg = f"Network error when contacting LM Studio API: {str(e)}"
-        print(error_msg)
-        return error_msg
-    except json.JSONDecodeError as e:
-        error_msg = f"Failed to parse LM Studio response as JSON: {str(e)}"
-        print(error_msg)
-        return error_msg
-    except Exception as e:
-        error_msg = f"Unexpected error when calling LM Studio API: {str(e)}"
-        print(error_msg)
-        return error_msg
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, response = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return response
+    
+    def put(self, key, response):
+        size = len(key) + len(response)
+        if size > self.max_chars:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, response)
+            self._chars += size
+            # Least recently used entries go first once either bound is exceeded
+            while len(self._entries) > self.max_entries or self._chars > self.max_chars:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._chars = 0
+    
+    def _remove(self, key):
+        _, response = self._entries.pop(key)
+        self._chars -= len(key) + len(response)
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "chars": self._chars,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+response_cache = ResponseCache()
+
+# A sentence ends with terminal punctuation (optionally followed by closing quotes/brackets) and whitespace
+SENTENCE_BOUNDARY_RE = re.compile(r'[.!?\u2026]+["\')\]]*\s+')
+
+def reply_budget(author_name, max_messages=REPLY_MAX_MESSAGES):
+    """(max_chars, max_tokens) for a reply to author_name.
+    
+    The allowance is what fits in max_messages chat messages once "@author " is in front
+    of the first one; max_tokens is derived from it, so REPLY_MAX_MESSAGES and
+    REPLY_CHARS_PER_TOKEN (not DEFAULT_MAX_TOKENS) decide how long chat replies get.
+    """
+    max_chars = max_messages * CHAT_MESSAGE_MAX_CHARS - len(f"@{author_name} ")
+    return max_chars, math.ceil(max_chars / REPLY_CHARS_PER_TOKEN)
+
+def split_sentences(text):
+    sentences = []
+    start = 0
+    for match in SENTENCE_BOUNDARY_RE.finditer(text):
+        sentences.append(text[start:match.end()].strip())
+        start = match.end()
+    if text[start:].strip():
+        sentences.append(text[start:].strip())
+    return sentences
+
+def trim_reply(text, max_chars):
+    """Cut text down to max_chars after the last whole sentence that fits, or after the last whole word"""
+    text = text.strip()
+    if len(text) <= max_chars:
+        return text
+    kept = ""
+    for sentence in split_sentences(text):
+        if len(kept) + len(sentence) + 1 > max_chars:
+            break
+        kept = f"{kept} {sentence}" if kept else sentence
+    if kept:
+        return kept
+    words = text[:max_chars].rsplit(" ", 1)[0] if " " in text[:max_chars] else text[:max_chars - 1]
+    return words.rstrip()[:max_chars - 1] + "\u2026"
+
+def split_message(text, limit=CHAT_MESSAGE_MAX_CHARS):
+    """Split text into chat messages of at most limit chars, between sentences where possible"""
+    parts = []
+    current = ""
+    for sentence in split_sentences(text):
+        if current and len(current) + 1 + len(sentence) <= limit:
+            current = f"{current} {sentence}"
+            continue
+        if current:
+            parts.append(current)
+        # A single sentence longer than a message is the only thing split between words
+        pieces = textwrap.wrap(sentence, limit) if len(sentence) > limit else [sentence]
+        parts.extend(pieces[:-1])
+        current = pieces[-1]
+    if current:
+        parts.append(current)
+    return parts
+
+def split_ready_chunks(text, min_chars=STREAM_MIN_CHUNK_CHARS):
+    """Split finished sentences off the front of text.
+    
+    Returns (chunks, remainder) where every chunk ends on a sentence boundary and is at least
+    min_chars long; whatever is left over is still being generated and stays in remainder.
+    """
+    chunks = []
+    start = 0
+    for match in SENTENCE_BOUNDARY_RE.finditer(text):
+        candidate = text[start:match.end()].strip()
+        if len(candidate) >= min_chars:
+            chunks.append(candidate)
+            start = match.end()
+    return chunks, text[start:]
 
 # ---------------------------
 # Flask Web Application for Whitelist Management
@@ -1286,6 +3866,7 @@ DASHBOARD_TEMPLATE = """
                     <span>{{ twitch_display_name }}</span>
                     <span class="user-badge">{{ user_role|capitalize }}</span>
                 </div>
+                <a href="{{ url_for('traces_view') }}" class="logout-btn">Traces</a>
                 <a href="{{ url_for('logout') }}" class="logout-btn">Logout</a>
             </div>
         </header>
@@ -1780,7 +4361,7 @@ def logout():
             }
             requests.post(revoke_url, data=revoke_params)
         except Exception as e:
-            print(f"Error revoking Twitch token: {str(e)}")
+            web_log.error("Error revoking Twitch token: %s", e)
     
     # Remove from active sessions if tracked
     if 'user_id' in session and session['user_id'] in active_sessions:
@@ -1805,7 +4386,7 @@ def dashboard():
         else:
             current_prompt = ""
     except Exception as e:
-        print(f"Error reading system prompt file: {e}")
+        web_log.error("Error reading system prompt file: %s", e)
         current_prompt = ""
         
     # Get message from session if exists
@@ -1854,8 +4435,7 @@ def add_user():
     username = request.form.get("username", "").strip().lower()
     
     # Debug the incoming data
-    print(f"Add user form data: {request.form}")
-    print(f"Parsed username: '{username}'")
+    web_log.info("Add user request for '%s'", username)
     
     if not username:
         session['error'] = True
@@ -1885,8 +4465,7 @@ def remove_user():
     username = request.form.get("username", "").strip().lower()
     
     # Debug the incoming data
-    print(f"Remove user form data: {request.form}")
-    print(f"Parsed username: '{username}'")
+    web_log.info("Remove user request for '%s'", username)
     
     if not username:
         session['error'] = True
@@ -1933,7 +4512,7 @@ def search_user():
         else:
             current_prompt = ""
     except Exception as e:
-        print(f"Error reading system prompt file: {e}")
+        web_log.error("Error reading system prompt file: %s", e)
         current_prompt = ""
     
     # Pass results to template
@@ -1953,6 +4532,199 @@ def search_user():
         user_role=session.get('user_role', 'guest')
     )
 
+# Prometheus scrape endpoint
+@app.route("/metrics")
+def metrics():
+    if not METRICS_ENABLED:
+        return "Metrics are disabled", 404
+    if METRICS_ALLOWED_IPS and request.remote_addr not in METRICS_ALLOWED_IPS:
+        web_log.warning("Refused /metrics scrape from %s, not in METRICS_ALLOWED_IPS", request.remote_addr)
+        return "Forbidden", 403
+    if METRICS_BEARER_TOKEN and not secrets.compare_digest(
+            request.headers.get("Authorization", ""), f"Bearer {METRICS_BEARER_TOKEN}"):
+        return Response("Unauthorized", 401, {"WWW-Authenticate": "Bearer"})
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+# Slowest recent mentions with their per-stage timings
+@app.route("/traces")
+@login_required
+def traces_view():
+    traces = trace_buffer.slowest(TRACES_SHOWN)
+    if request.args.get("format") == "json":
+        return jsonify([trace.to_dict() for trace in traces])
+    return render_template_string("""
+        <!doctype html>
+        <html>
+            <head>
+                <title>Slowest Mentions</title>
+                <style>
+                    body {
+                        font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
+                        background: #121212;
+                        color: #e0e0e0;
+                        margin: 0;
+                        padding: 0;
+                        line-height: 1.6;
+                    }
+                    .container {
+                        max-width: 1000px;
+                        margin: 2rem auto;
+                        padding: 0 1rem;
+                    }
+                    .card {
+                        background: #1e1e1e;
+                        border-radius: 8px;
+                        box-shadow: 0 4px 10px rgba(0, 0, 0, 0.2);
+                        padding: 1.5rem;
+                        margin-bottom: 1.5rem;
+                    }
+                    h1, h2 {
+                        color: #bb86fc;
+                        margin-top: 0;
+                    }
+                    h2 {
+                        font-size: 1.1rem;
+                    }
+                    .meta {
+                        color: #888;
+                        font-size: 0.9rem;
+                    }
+                    table {
+                        width: 100%;
+                        border-collapse: collapse;
+                    }
+                    th, td {
+                        padding: 0.3rem 0.8rem;
+                        text-align: left;
+                        border-bottom: 1px solid #333;
+                        font-size: 0.9rem;
+                    }
+                    th {
+                        color: #bb86fc;
+                    }
+                    .timeline {
+                        position: relative;
+                        width: 100%;
+                        min-width: 200px;
+                        height: 12px;
+                        background: #2a2a2a;
+                        border-radius: 3px;
+                    }
+                    .bar {
+                        position: absolute;
+                        height: 12px;
+                        min-width: 2px;
+                        background: #03dac6;
+                        border-radius: 3px;
+                    }
+                    .error {
+                        color: #cf6679;
+                    }
+                    .footer {
+                        text-align: center;
+                        margin-top: 2rem;
+                        color: #888;
+                    }
+                    .back-btn {
+                        display: inline-block;
+                        background: #bb86fc;
+                        color: #121212;
+                        text-decoration: none;
+                        padding: 0.5rem 1rem;
+                        border-radius: 4px;
+                        margin-top: 1rem;
+                    }
+                    .back-btn:hover {
+                        background: #a370d8;
+                    }
+                </style>
+            </head>
+            <body>
+                <div class="container">
+                    <div class="card">
+                        <h1>Slowest Mentions</h1>
+                        <p class="meta">The {{ traces|length }} slowest of the last {{ buffered }} traced mentions.
+                            <a href="{{ url_for('traces_view', format='json') }}">JSON</a></p>
+                        <a href="{{ url_for('dashboard') }}" class="back-btn">Back to Dashboard</a>
+                    </div>
+                    {% for trace in traces %}
+                    <div class="card">
+                        <h2>{{ '%.0f'|format(trace.duration * 1000) }} ms &middot; {{ trace.user }} in #{{ trace.channel }} ({{ trace.context }} context)
+                            {% if trace.outcome != 'ok' %}<span class="error">{{ trace.outcome }}</span>{% endif %}</h2>
+                        <p class="meta">Trace {{ trace.trace_id }} at {{ format_time(trace.wall_started) }}</p>
+                        <table>
+                            <thead>
+                                <tr>
+                                    <th>Stage</th>
+                                    <th>Start</th>
+                                    <th>Duration</th>
+                                    <th>Timeline</th>
+                                    <th>Details</th>
+                                </tr>
+                            </thead>
+                            <tbody>
+                                {% for name, offset, duration, details in trace.spans %}
+                                <tr>
+                                    <td>{{ name }}</td>
+                                    <td>{{ '%.1f'|format(offset * 1000) }} ms</td>
+                                    <td>{{ '%.1f'|format(duration * 1000) }} ms</td>
+                                    <td>
+                                        <div class="timeline">
+                                            <div class="bar" style="left: {{ '%.2f'|format(100 * offset / trace.duration) }}%; width: {{ '%.2f'|format(100 * duration / trace.duration) }}%;"></div>
+                                        </div>
+                                    </td>
+                                    <td>{% for key, value in details.items() %}{{ key }}={{ value }} {% endfor %}</td>
+                                </tr>
+                                {% endfor %}
+                            </tbody>
+                        </table>
+                    </div>
+                    {% else %}
+                    <div class="card">
+                        <p>No mentions traced yet.</p>
+                    </div>
+                    {% endfor %}
+                </div>
+                <div class="footer">
+                    made by ShadowDog using AI
+                </div>
+            </body>
+        </html>
+    """, traces=traces, buffered=len(trace_buffer),
+        format_time=lambda ts: time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts)))
+
+# LLM scheduler stats for sizing the LM Studio backend
+@app.route("/llm_stats")
+@login_required
+def llm_stats():
+    if twitch_bot is None:
+        return jsonify({"error": "Twitch bot is not running"}), 503
+    return jsonify({
+        "scheduler": twitch_bot.llm_scheduler.stats(),
+        "cache": response_cache.stats(),
+        "coalescing": twitch_bot.inflight_requests.stats(),
+        "context": context_budget.stats(),
+        "conversations": user_conversations.stats(),
+        "conversation_store": conversation_store.stats() if conversation_store else None,
+        "channels": {name: channel.stats() for name, channel in list(channel_contexts.items())},
+        "outbound": twitch_bot.outbound.stats(),
+        "shards": [{
+            "shard": bot.shard,
+            "channels": bot.channel_names,
+            "connected": bot.chat_ready(),
+            "reconnects": bot.reconnects,
+            "ping_rtt": bot.ping_rtt
+        } for bot in twitch_bots],
+        "prefix_cache": twitch_bot.llm_client.prefix_cache.stats(),
+        "backends": twitch_bot.llm_client.backends.stats(),
+        "resilience": {
+            "fail_fast": twitch_bot.llm_client.backends.fail_fast,
+            "hedge_delay": twitch_bot.llm_client.backends.hedge_delay(),
+            "hedges_fired": twitch_bot.llm_client.hedges_fired,
+            "hedges_won": twitch_bot.llm_client.hedges_won
+        }
+    })
+
 # Add a route to serve the WeirdDude.png image
 @app.route("/weird-dude")
 def weird_dude():
@@ -1968,7 +4740,7 @@ import shutil
 try:
     shutil.copy2('WeirdDude.png', 'static/WeirdDude.png')
 except:
-    print("Warning: Could not copy WeirdDude.png to static folder")
+    web_log.warning("Could not copy WeirdDude.png to static folder")
 
 def run_flask():
     print("\n🔥 Flask server starting on http://0.0.0.0:5420")
@@ -1978,34 +4750,52 @@ def run_flask():
 # Main Execution
 # ---------------------------
 def run_twitch_bot():
-    global should_restart
+    global should_restart, twitch_bot, twitch_bots
     
+    crashes = 0
     while True:
+        started = time.monotonic()
         try:
-            print("Starting Twitch bot...")
+            bot_log.info("Starting Twitch bot...")
             
             # First create a new event loop and set it as the current loop
             loop = asyncio.new_event_loop()
             asyncio.set_event_loop(loop)
             
-            # Now create the bot, which will use the current event loop
-            bot = TwitchBot()
+            # Now create one bot per shard, which will use the current event loop
+            bots = []
+            for shard, channels in enumerate(assign_shards(bot_channels())):
+                if not channels:
+                    continue
+                for name in channels:
+                    channel = get_channel(name)
+                    channel.reload()
+                    channel.shard = shard
+                bot_log.info("Shard %d serves: %s", shard, ", ".join(channels))
+                bots.append(TwitchBot(channels, shard, shared_with=bots[0] if bots else None))
+            twitch_bot = bots[0]
+            twitch_bots = bots
             
-            # Run the bot in this same loop
-            loop.run_until_complete(bot.start())
+            # Run every shard in this same loop, if one fails they're all restarted
+            loop.run_until_complete(asyncio.gather(*(bot.start() for bot in bots)))
             loop.close()
         except Exception as e:
-            print(f"Twitch bot error: {e}")
+            bot_log.exception("Twitch bot error: %s", e)
         
         # Check if we should restart due to system prompt update
         if should_restart:
-            print("Restarting Twitch bot due to system prompt update...")
+            bot_log.info("Restarting Twitch bot due to system prompt update...")
             should_restart = False  # Reset the flag
             time.sleep(1)  # Small delay before restart
         else:
-            # If it's a normal crash/exit, wait before reconnecting
-            print("Twitch bot disconnected, reconnecting in 5 seconds...")
-            time.sleep(2)
+            # If it's a normal crash/exit, back off before reconnecting
+            if time.monotonic() - started > CHAT_RESTART_RESET_AFTER:
+                crashes = 0
+            delay = reconnect_delay(crashes)
+            crashes += 1
+            bot_log.warning("Twitch bot disconnected, reconnecting in %.1f seconds...", delay)
+            WEBSOCKET_RECONNECTS.inc(labels=("restart",))
+            time.sleep(delay)
 
 # Route to handle system prompt updates
 @app.route("/update_system_prompt", methods=["POST"])
@@ -2056,7 +4846,7 @@ def update_system_prompt():
 # Function to restart the server
 def restart_server():
     # Wait longer to ensure the page has time to fully load and display the updated prompt
-    print("Scheduling bot restart in 5 seconds...")
+    bot_log.info("Scheduling bot restart in 5 seconds...")
     time.sleep(2)
     
     # Update the global system prompt variable
@@ -2066,12 +4856,15 @@ def restart_server():
             system_prompt = f.read() or "You are a helpful assistant."  # Removed .strip() to preserve formatting
         # Always reapply the safety rule
         system_prompt = SAFETY_RULE + system_prompt
-        print("System prompt updated to:", system_prompt)
+        bot_log.info("System prompt updated (%d chars)", len(system_prompt))
+        bot_log.debug("System prompt is now: %s", system_prompt)
+        # Cached replies were generated under the old prompt
+        response_cache.clear()
     except Exception as e:
-        print(f"Error reading system prompt during restart: {e}")
+        bot_log.error("Error reading system prompt during restart: %s", e)
         return
     
-    print("Restarting bot threads...")
+    bot_log.info("Restarting bot threads...")
     
     # Signal to restart the Twitch bot thread
     global should_restart
@@ -2248,25 +5041,25 @@ def reset_system_prompt():
     try:
         # Print current working directory for debugging
         current_dir = os.getcwd()
-        print(f"Current working directory: {current_dir}")
+        web_log.debug("Current working directory: %s", current_dir)
         
         # Get absolute paths for better debugging
         default_prompt_path = os.path.abspath(DEFAULT_SYSTEM_PROMPT_FILE)
         system_prompt_path = os.path.abspath(SYSTEM_PROMPT_FILE)
         
-        print(f"Looking for default system prompt at: {default_prompt_path}")
-        print(f"Will write to active system prompt at: {system_prompt_path}")
+        web_log.debug("Looking for default system prompt at: %s", default_prompt_path)
+        web_log.debug("Will write to active system prompt at: %s", system_prompt_path)
         
         # Check if default system prompt file exists
         if not os.path.exists(default_prompt_path):
             # Try looking in the same directory as this script
             script_dir = os.path.dirname(os.path.abspath(__file__))
             alternative_path = os.path.join(script_dir, os.path.basename(DEFAULT_SYSTEM_PROMPT_FILE))
-            print(f"File not found. Trying alternative path: {alternative_path}")
+            web_log.info("File not found. Trying alternative path: %s", alternative_path)
             
             if os.path.exists(alternative_path):
                 default_prompt_path = alternative_path
-                print(f"Found file at alternative path: {default_prompt_path}")
+                web_log.info("Found file at alternative path: %s", default_prompt_path)
             else:
                 session['error'] = True
                 session['message'] = f"Default system prompt file not found at {default_prompt_path} or {alternative_path}"
@@ -2275,12 +5068,12 @@ def reset_system_prompt():
         # Read the default system prompt
         with open(default_prompt_path, "r", encoding="utf-8") as f:
             default_prompt = f.read()
-            print(f"Successfully read default prompt: {len(default_prompt)} chars")
+            web_log.debug("Successfully read default prompt: %d chars", len(default_prompt))
             
         # Write it to the active system prompt file
         with open(system_prompt_path, "w", encoding="utf-8") as f:
             f.write(default_prompt)
-            print(f"Successfully wrote to system prompt file")
+            web_log.info("Reset the system prompt to the default")
         
         # Set a success message
         session['message'] = "System prompt reset to default. The server will restart momentarily."
@@ -2292,18 +5085,12 @@ def reset_system_prompt():
         # Redirect to dashboard to show the updated prompt
         return redirect(url_for('dashboard'))
     except Exception as e:
-        import traceback
-        traceback_str = traceback.format_exc()
-        print(f"Error resetting system prompt: {str(e)}")
-        print(f"Traceback: {traceback_str}")
+        web_log.exception("Error resetting system prompt: %s", e)
         session['error'] = True
         session['message'] = f"Error resetting system prompt: {str(e)}"
         return redirect(url_for('dashboard'))
 
 if __name__ == "__main__":
-    ws_thread = threading.Thread(target=connect_to_twitch_ws, daemon=True)
-    ws_thread.start()
-    
     flask_thread = threading.Thread(target=run_flask, daemon=True)
     flask_thread.start()
     
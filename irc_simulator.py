@@ -0,0 +1,282 @@
+"""Local Twitch IRC-over-WebSocket simulator for offline end-to-end benchmarks.
+
+Speaks enough of Twitch chat (PASS/NICK, CAP, JOIN, PING, tagged PRIVMSGs) for the
+TwitchIO bot to connect, replays chat into the channel at a configurable rate and
+records every PRIVMSG the bot sends back. Replies are
+matched to the mention they answer, giving receive -> reply latency for the whole bot.
+
+Set TWITCH_IRC_WS_URL = "ws://127.0.0.1:6680" in cyrai.py (and run mock_lm_studio.py
+if there's no LM Studio around), then:
+
+    python irc_simulator.py --channel mychannel --rate 5 --mention-ratio 0.3 --duration 60
+
+--channel takes a comma separated list to load several channels (STREAMER_CHANNEL plus
+EXTRA_CHANNELS) at once; latency is then also reported per channel.
+
+--disconnect-every drops the bot's connections every so many seconds, to check replies
+survive reconnects.
+
+Mentions are sent from whitelisted users (whitelist.txt by default) so the bot answers
+them, the rest of the chat comes from a pool of --users random chatters.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import time
+import uuid
+
+from aiohttp import web, WSMsgType
+
+from percentiles import percentile
+
+FILLER = [
+    "LUL", "that was close", "gg", "pog", "what game is this", "hi chat", "KEKW",
+    "nice play", "first time here", "this music slaps", "lets go", "F", "monkaS",
+]
+PROMPTS = [
+    "what do you think about this game",
+    "tell me a fun fact about space",
+    "how is the stream going today",
+    "give me a tip for the next boss",
+    "what should we name the new pet",
+    "(global) what is the plan for tonight",
+]
+
+def load_replay(path):
+    """Lines of "user: message" (or "user<TAB>message") to replay instead of generated chat"""
+    lines = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            separator = "\t" if "\t" in line else ":"
+            user, _, text = line.partition(separator)
+            if user.strip() and text.strip():
+                lines.append((user.strip().lower(), text.strip()))
+    return lines
+
+class ChatSimulator:
+    def __init__(self, args):
+        self.args = args
+        self.channels = [name.strip().lower().lstrip("#") for name in args.channel.split(",") if name.strip()]
+        self.clients = set()
+        self.bot_nick = args.bot_nick
+        self.started = None
+        self.mentions = {}  # (channel, user) -> list of mention records still waiting for a reply
+        self.records = []  # every mention sent
+        self.outbound = []  # (timestamp, nick, text) of every PRIVMSG the bot sent
+        self.chat_sent = 0
+        self.connections = 0
+        self.disconnects = 0
+        self.chat_finished = None
+        self.user_ids = {}
+        self.population = [f"viewer{i}" for i in range(args.users)]
+        self.mention_users = self._load_mention_users()
+        self.replay = load_replay(args.replay) if args.replay else None
+        self.capture = open(args.capture, "w", encoding="utf-8") if args.capture else None
+
+    def _load_mention_users(self):
+        if self.args.mention_users:
+            return [name.strip().lower() for name in self.args.mention_users.split(",") if name.strip()]
+        if os.path.exists(self.args.whitelist):
+            with open(self.args.whitelist, "r", encoding="utf-8") as f:
+                names = [line.strip().lower() for line in f if line.strip()]
+            if names:
+                return names
+        print(f"No whitelisted users found in {self.args.whitelist}, mentions come from random viewers")
+        return self.population
+
+    def log(self, event, **fields):
+        if self.capture:
+            self.capture.write(json.dumps({"t": time.time(), "event": event, **fields}) + "\n")
+
+    # IRC side
+
+    async def handle_client(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        client = {"ws": ws, "nick": None, "channels": set()}
+        self.clients.add(ws)
+        self.connections += 1
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                # TwitchIO terminates lines with CRLF, other clients may not
+                for line in msg.data.split("\r\n"):
+                    line = line.strip()
+                    if line:
+                        await self.handle_line(client, line)
+        finally:
+            self.clients.discard(ws)
+        return ws
+
+    async def handle_line(self, client, line):
+        ws = client["ws"]
+        command, _, rest = line.partition(" ")
+        command = command.upper()
+        if command == "PASS":
+            return
+        if command == "NICK":
+            nick = rest.strip().lower()
+            client["nick"] = nick
+            self.bot_nick = self.bot_nick or nick
+            await ws.send_str(
+                f":tmi.twitch.tv 001 {nick} :Welcome, GLHF!\r\n"
+                f":tmi.twitch.tv 002 {nick} :Your host is tmi.twitch.tv\r\n"
+                f":tmi.twitch.tv 003 {nick} :This server is rather new\r\n"
+                f":tmi.twitch.tv 004 {nick} :-\r\n"
+                f":tmi.twitch.tv 375 {nick} :-\r\n"
+                f":tmi.twitch.tv 372 {nick} :You are in a maze of twisty passages, all alike.\r\n"
+                f":tmi.twitch.tv 376 {nick} :>\r\n"
+            )
+        elif command == "CAP":
+            await ws.send_str(f":tmi.twitch.tv CAP * ACK :{rest.split(':', 1)[-1]}\r\n")
+        elif command == "JOIN":
+            nick = client["nick"] or "justinfan"
+            for channel in rest.strip().split(","):
+                channel = channel.lstrip("#").lower()
+                client["channels"].add(channel)
+                await ws.send_str(
+                    f":{nick}!{nick}@{nick}.tmi.twitch.tv JOIN #{channel}\r\n"
+                    f":{nick}.tmi.twitch.tv 353 {nick} = #{channel} :{nick}\r\n"
+                    f":{nick}.tmi.twitch.tv 366 {nick} #{channel} :End of /NAMES list\r\n"
+                )
+        elif command == "PING":
+            await ws.send_str(f":tmi.twitch.tv PONG tmi.twitch.tv {rest}\r\n")
+        elif command == "PRIVMSG":
+            target, _, text = rest.partition(" :")
+            self.record_outbound(client["nick"], target, text)
+
+    def record_outbound(self, nick, target, text):
+        now = time.perf_counter()
+        self.outbound.append((now, nick, text))
+        self.log("outbound", nick=nick, target=target, text=text)
+        # The bot merges replies when it's rate limited, so one message can answer several mentions
+        for user in re.findall(r"(?:^| )@(\w+)", text):
+            waiting = self.mentions.get((target.lstrip("#").lower(), user.lower()))
+            if waiting:
+                record = waiting.pop(0)
+                record["replied"] = now
+
+    async def disconnect_loop(self):
+        while True:
+            await asyncio.sleep(self.args.disconnect_every)
+            for ws in list(self.clients):
+                self.disconnects += 1
+                self.log("disconnect")
+                await ws.close()
+
+    async def broadcast(self, channel, user, text):
+        user_id = self.user_ids.setdefault(user, str(100000 + len(self.user_ids)))
+        tags = (
+            f"@badge-info=;badges=;color=#1E90FF;display-name={user};emotes=;first-msg=0;flags=;"
+            f"id={uuid.uuid4()};mod=0;returning-chatter=0;room-id=1;subscriber=0;"
+            f"tmi-sent-ts={int(time.time() * 1000)};turbo=0;user-id={user_id};user-type="
+        )
+        line = f"{tags} :{user}!{user}@{user}.tmi.twitch.tv PRIVMSG #{channel} :{text}\r\n"
+        for ws in list(self.clients):
+            if not ws.closed:
+                await ws.send_str(line)
+        self.chat_sent += 1
+        self.log("chat", channel=channel, user=user, text=text)
+
+    # Chat generation
+
+    def next_message(self, number):
+        if self.replay:
+            user, text = self.replay[number % len(self.replay)]
+            return user, text, self.bot_nick.lower() in text.lower()
+        if random.random() < self.args.mention_ratio:
+            return random.choice(self.mention_users), f"@{self.bot_nick} {random.choice(PROMPTS)}", True
+        return random.choice(self.population), random.choice(FILLER), False
+
+    async def run_chat(self):
+        print(f"Waiting for the bot to join {', '.join('#' + name for name in self.channels)}...")
+        while not self.bot_nick or not self.clients:
+            await asyncio.sleep(0.2)
+        await asyncio.sleep(self.args.warmup)
+        print(f"Replaying chat at {self.args.rate} msg/s for {self.args.duration}s as {self.bot_nick} joined")
+
+        self.started = time.perf_counter()
+        deadline = self.started + self.args.duration
+        number = 0
+        while time.perf_counter() < deadline:
+            user, text, is_mention = self.next_message(number)
+            channel = random.choice(self.channels)
+            number += 1
+            if is_mention:
+                record = {"channel": channel, "user": user, "sent": time.perf_counter(), "replied": None}
+                self.records.append(record)
+                self.mentions.setdefault((channel, user), []).append(record)
+            await self.broadcast(channel, user, text)
+            await asyncio.sleep(random.expovariate(self.args.rate))
+        self.chat_finished = time.perf_counter()
+
+        # Give the last mentions a chance to be answered
+        grace_deadline = time.perf_counter() + self.args.grace
+        while time.perf_counter() < grace_deadline and any(r["replied"] is None for r in self.records):
+            await asyncio.sleep(0.2)
+
+    def report(self):
+        latencies = [r["replied"] - r["sent"] for r in self.records if r["replied"] is not None]
+        elapsed = time.perf_counter() - self.started
+        chat_elapsed = self.chat_finished - self.started
+        outbound = [entry for entry in self.outbound if entry[0] >= self.started]
+        print(f"Chat:       {self.chat_sent} messages in {chat_elapsed:.1f}s ({self.chat_sent / chat_elapsed:.2f}/s)")
+        print(f"Mentions:   {len(self.records)} sent, {len(latencies)} answered, "
+              f"{len(self.records) - len(latencies)} unanswered")
+        print(f"Outbound:   {len(outbound)} PRIVMSGs, {len(latencies) / elapsed:.2f} replies/s")
+        if self.disconnects:
+            print(f"Reconnects: {self.disconnects} connections dropped, {self.connections} opened")
+        print(f"Latency:    p50 {percentile(latencies, 0.5) * 1000:.0f} ms   "
+              f"p95 {percentile(latencies, 0.95) * 1000:.0f} ms   "
+              f"p99 {percentile(latencies, 0.99) * 1000:.0f} ms   "
+              f"max {max(latencies, default=0.0) * 1000:.0f} ms")
+        if len(self.channels) > 1:
+            for channel in self.channels:
+                records = [r for r in self.records if r["channel"] == channel]
+                answered = [r["replied"] - r["sent"] for r in records if r["replied"] is not None]
+                print(f"  #{channel}: {len(answered)}/{len(records)} answered, "
+                      f"p50 {percentile(answered, 0.5) * 1000:.0f} ms   p95 {percentile(answered, 0.95) * 1000:.0f} ms")
+        if self.capture:
+            self.capture.close()
+            print(f"Captured traffic written to {self.args.capture}")
+
+async def main(args):
+    simulator = ChatSimulator(args)
+    app = web.Application()
+    app.router.add_get("/", simulator.handle_client)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    print(f"Twitch IRC simulator listening on ws://{args.host}:{args.port}")
+    disconnects = asyncio.create_task(simulator.disconnect_loop()) if args.disconnect_every else None
+    try:
+        await simulator.run_chat()
+        simulator.report()
+    finally:
+        if disconnects:
+            disconnects.cancel()
+        await runner.cleanup()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline Twitch chat simulator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6680)
+    parser.add_argument("--channel", required=True, help="channel(s) the bot joins, comma separated")
+    parser.add_argument("--bot-nick", help="bot name used in mentions (default: the nick the bot logs in with)")
+    parser.add_argument("--rate", type=float, default=2.0, help="average chat messages per second")
+    parser.add_argument("--mention-ratio", type=float, default=0.2, help="share of messages that mention the bot")
+    parser.add_argument("--users", type=int, default=200, help="size of the random viewer population")
+    parser.add_argument("--whitelist", default="whitelist.txt", help="users mentions are sent from")
+    parser.add_argument("--mention-users", help="comma separated users to send mentions from instead")
+    parser.add_argument("--replay", help='file of "user: message" lines to replay instead of generated chat')
+    parser.add_argument("--duration", type=float, default=60, help="seconds of chat to send")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds to wait after the bot joins")
+    parser.add_argument("--grace", type=float, default=30, help="seconds to wait for replies after the chat stops")
+    parser.add_argument("--disconnect-every", type=float, help="drop the bot's connections every this many seconds")
+    parser.add_argument("--capture", help="write every chat line and bot PRIVMSG to this JSONL file")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,263 @@
+"""Load generator for the bot's LLM path.
+
+Feeds synthetic mentions from N chatters through TwitchBot.event_message, the same
+path real chat takes (context budgeting, cache, coalescing, scheduler, LM Studio
+client), and captures the replies instead of sending them to Twitch. Run it against
+mock_lm_studio.py to catch performance regressions without a GPU or network:
+
+    python llm_benchmark.py --start-mock --chatters 20 --mentions 5
+    python llm_benchmark.py --url http://localhost:1234/v1/chat/completions --rate 8 --duration 30
+
+By default every chatter waits for its reply before sending the next mention (closed
+loop). With --rate mentions arrive at that average rate no matter how far behind the
+bot is (open loop), which is how chat behaves during a raid.
+"""
+import argparse
+import asyncio
+import atexit
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from percentiles import percentile
+
+BOT_NAME = "benchbot"
+PROMPTS = [
+    "what do you think about this game",
+    "tell me a fun fact about space",
+    "how is the stream going today",
+    "give me a tip for the next boss",
+    "what should we name the new pet",
+    "can you summarize what happened so far",
+    "(global) what is the plan for tonight",
+]
+
+def import_bot():
+    """Import cyrai from a scratch directory so the benchmark never touches the bot's
+    whitelist, system prompt or stored conversations"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    workdir = tempfile.mkdtemp(prefix="cyrai-bench-")
+    atexit.register(shutil.rmtree, workdir, True)
+    os.chdir(workdir)
+    sys.path.insert(0, here)
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        import cyrai
+    return cyrai
+
+def start_mock(args):
+    port = int(args.url[0].split(":")[2].split("/")[0])
+    mock = subprocess.Popen([
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_lm_studio.py"),
+        "--port", str(port), "--ttft", str(args.mock_ttft),
+        "--tokens-per-second", str(args.mock_tokens_per_second),
+        "--error-rate", str(args.mock_error_rate), "--parallel", str(args.mock_parallel),
+    ], stdout=subprocess.DEVNULL)
+    atexit.register(mock.terminate)
+    models_url = args.url[0].rsplit("/chat/completions", 1)[0] + "/models"
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(models_url, timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    sys.exit(f"Mock LM Studio didn't come up on {models_url}")
+
+class Author:
+    def __init__(self, name):
+        self.name = name
+        self.display_name = name
+        self.is_mod = False
+        self.is_broadcaster = False
+
+class Channel:
+    name = "benchmark"
+
+    async def send(self, content):
+        pass
+
+class Message:
+    def __init__(self, author, content, channel):
+        self.author = Author(author)
+        self.content = content
+        self.channel = channel
+        self.echo = False
+        self.tags = {}
+
+class Benchmark:
+    def __init__(self, cyrai, args):
+        self.cyrai = cyrai
+        self.args = args
+        self.channel = Channel()
+        self.current = contextvars.ContextVar("current_mention")
+        self.mentions = []  # one dict per mention: sent, first_reply, done, replies
+        self.queue_delays = []
+
+    def setup_bot(self):
+        cyrai = self.cyrai
+        bot = cyrai.TwitchBot()
+
+        def capture_reply(reply, channel=None, priority=None, deadline=None):
+            # Instead of the outbound queue, whose chat rate limit would dominate the numbers
+            mention = self.current.get(None)
+            if mention is not None:
+                if mention["first_reply"] is None:
+                    mention["first_reply"] = time.perf_counter()
+                mention["replies"] += 1
+            sent = asyncio.get_running_loop().create_future()
+            sent.set_result(True)
+            return sent
+
+        async def no_commands(message):
+            pass
+
+        bot.handle_reply = capture_reply
+        bot.handle_commands = no_commands
+        if self.args.concurrency:
+            bot.llm_scheduler.max_concurrency = self.args.concurrency
+
+        # Time spent waiting for a scheduler slot, measured per request
+        scheduler_run = bot.llm_scheduler.run
+
+        async def timed_run(user_id, job, background=False):
+            enqueued_at = time.perf_counter()
+
+            async def timed_job():
+                self.queue_delays.append(time.perf_counter() - enqueued_at)
+                return await job()
+
+            return await scheduler_run(user_id, timed_job, background=background)
+
+        bot.llm_scheduler.run = timed_run
+        return bot
+
+    async def mention(self, bot, chatter, number):
+        prompt = random.choice(PROMPTS)
+        record = {"sent": time.perf_counter(), "first_reply": None, "done": None, "replies": 0}
+        self.mentions.append(record)
+        self.current.set(record)
+        await bot.event_message(Message(chatter, f"@{BOT_NAME} {prompt} #{number}", self.channel))
+        record["done"] = time.perf_counter()
+
+    async def closed_loop(self, bot, chatters):
+        async def chatter_loop(chatter):
+            for number in range(self.args.mentions):
+                await self.mention(bot, chatter, number)
+                await asyncio.sleep(random.expovariate(1 / self.args.think_time) if self.args.think_time else 0)
+
+        await asyncio.gather(*(chatter_loop(chatter) for chatter in chatters))
+
+    async def open_loop(self, bot, chatters):
+        tasks = []
+        deadline = time.perf_counter() + self.args.duration
+        number = 0
+        while time.perf_counter() < deadline:
+            # Each mention runs in its own context, so replies are attributed correctly
+            tasks.append(asyncio.create_task(self.mention(bot, random.choice(chatters), number)))
+            number += 1
+            await asyncio.sleep(random.expovariate(self.args.rate))
+        await asyncio.gather(*tasks)
+
+    async def run(self):
+        chatters = [f"chatter{i}" for i in range(self.args.chatters)]
+        self.cyrai.whitelist.update(chatters)
+        bot = self.setup_bot()
+        if self.args.verbose:
+            self.cyrai.setup_logging(log_file=None)
+        else:
+            logging.getLogger("cyrai").setLevel(logging.CRITICAL)
+        output = sys.stdout if self.args.verbose else open(os.devnull, "w")
+        started = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(output):
+                if self.args.rate:
+                    await self.open_loop(bot, chatters)
+                else:
+                    await self.closed_loop(bot, chatters)
+        finally:
+            elapsed = time.perf_counter() - started
+            await bot.llm_client.close()
+        return self.report(bot, elapsed)
+
+    def report(self, bot, elapsed):
+        answered = [m for m in self.mentions if m["first_reply"] is not None]
+        first_reply = [m["first_reply"] - m["sent"] for m in answered]
+        total = [m["done"] - m["sent"] for m in answered]
+        return {
+            "mentions": len(self.mentions),
+            "answered": len(answered),
+            "dropped": len(self.mentions) - len(answered),
+            "elapsed_seconds": elapsed,
+            "throughput_per_second": len(answered) / elapsed if elapsed else 0.0,
+            "first_reply_p50": percentile(first_reply, 0.5),
+            "first_reply_p95": percentile(first_reply, 0.95),
+            "first_reply_p99": percentile(first_reply, 0.99),
+            "latency_p50": percentile(total, 0.5),
+            "latency_p95": percentile(total, 0.95),
+            "latency_p99": percentile(total, 0.99),
+            "queue_delay_p50": percentile(self.queue_delays, 0.5),
+            "queue_delay_p95": percentile(self.queue_delays, 0.95),
+            "queue_delay_p99": percentile(self.queue_delays, 0.99),
+            "scheduler_rejected": bot.llm_scheduler.stats()["rejected"],
+            "backends": bot.llm_client.backends.stats(),
+        }
+
+def print_report(report):
+    print(f"Mentions:    {report['mentions']} ({report['answered']} answered, {report['dropped']} dropped, "
+          f"{report['scheduler_rejected']} rejected by the scheduler)")
+    print(f"Elapsed:     {report['elapsed_seconds']:.2f}s, {report['throughput_per_second']:.2f} replies/s")
+    for label, key in (("First reply", "first_reply"), ("Full reply", "latency"), ("Queue delay", "queue_delay")):
+        print(f"{label + ':':<13}p50 {report[key + '_p50'] * 1000:7.0f} ms   "
+              f"p95 {report[key + '_p95'] * 1000:7.0f} ms   p99 {report[key + '_p99'] * 1000:7.0f} ms")
+    for backend in report["backends"]:
+        print(f"Backend {backend['url']}: {backend['requests']} requests, {backend['errors']} errors, "
+              f"circuit {backend['state']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot's LLM path with synthetic chatters")
+    parser.add_argument("--url", action="append", help="LM Studio chat completions URL (repeat for a pool)")
+    parser.add_argument("--chatters", type=int, default=10, help="number of synthetic chatters")
+    parser.add_argument("--mentions", type=int, default=5, help="mentions per chatter (closed loop)")
+    parser.add_argument("--think-time", type=float, default=0.5, help="mean pause between a chatter's mentions")
+    parser.add_argument("--rate", type=float, help="open loop: average mentions per second across all chatters")
+    parser.add_argument("--duration", type=float, default=30, help="open loop: seconds to keep sending")
+    parser.add_argument("--no-stream", action="store_true", help="use non-streaming completions")
+    parser.add_argument("--cache", action="store_true", help="leave the response cache on")
+    parser.add_argument("--concurrency", type=int, help="concurrent generations, instead of LLM_MAX_CONCURRENCY")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's own log output")
+    parser.add_argument("--start-mock", action="store_true", help="run mock_lm_studio.py for the duration")
+    parser.add_argument("--mock-ttft", type=float, default=0.3)
+    parser.add_argument("--mock-tokens-per-second", type=float, default=40)
+    parser.add_argument("--mock-error-rate", type=float, default=0.0)
+    parser.add_argument("--mock-parallel", type=int, default=4)
+    args = parser.parse_args()
+    args.url = args.url or ["http://localhost:1234/v1/chat/completions"]
+
+    if args.start_mock:
+        start_mock(args)
+
+    cyrai = import_bot()
+    cyrai.TWITCH_USERNAME = BOT_NAME
+    cyrai.LM_STUDIO_API_URLS[:] = args.url
+    cyrai.LM_STUDIO_STREAM = not args.no_stream
+    cyrai.RESPONSE_CACHE_ENABLED = args.cache
+    cyrai.conversation_store = None
+
+    report = asyncio.run(Benchmark(cyrai, args).run())
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Mock LM Studio server for load testing the bot without a GPU.
+
+Speaks the OpenAI-compatible endpoints the bot uses (/v1/chat/completions, streaming
+or not, and /v1/models for health checks) and fakes the timing of a real backend:
+time to first token, decode speed, a limited number of parallel slots and a share of
+failing requests.
+
+    python mock_lm_studio.py --port 1234 --ttft 0.4 --tokens-per-second 30 --error-rate 0.02
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+WORDS = (
+    "sure thing chat that is a great question honestly the stream has been wild today "
+    "i think the boss fight needs more practice but we are getting there slowly "
+    "thanks for hanging out everyone remember to stay hydrated and be nice"
+).split()
+
+def make_reply(num_tokens):
+    """A reply of num_tokens words split into short sentences, so sentence chunking gets exercised"""
+    tokens = []
+    sentence_length = 0
+    for i in range(num_tokens):
+        word = random.choice(WORDS)
+        if sentence_length == 0:
+            word = word.capitalize()
+        sentence_length += 1
+        if sentence_length >= random.randint(6, 14) or i == num_tokens - 1:
+            word += random.choice(".!?")
+            sentence_length = 0
+        tokens.append(word if i == 0 else " " + word)
+    return tokens
+
+class MockBackend:
+    def __init__(self, args):
+        self.args = args
+        # Requests beyond the slot count wait, like a llama.cpp server started with --parallel
+        self.slots = asyncio.Semaphore(args.parallel)
+        self.requests = 0
+        self.errors = 0
+        self.active = 0
+
+    def jittered(self, seconds):
+        return max(0.0, seconds * random.uniform(1 - self.args.jitter, 1 + self.args.jitter))
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        self.requests += 1
+
+        if random.random() < self.args.error_rate:
+            self.errors += 1
+            return web.json_response({"error": {"message": "mock backend failure"}}, status=500)
+
+        max_tokens = body.get("max_tokens") or self.args.reply_tokens
+        if max_tokens < 0:
+            max_tokens = self.args.reply_tokens
+        num_tokens = min(max_tokens, self.args.reply_tokens)
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in body.get("messages", []))
+        token_delay = 1 / self.args.tokens_per_second
+
+        async with self.slots:
+            self.active += 1
+            try:
+                await asyncio.sleep(self.jittered(self.args.ttft))
+                tokens = make_reply(num_tokens)
+
+                if not body.get("stream"):
+                    await asyncio.sleep(self.jittered(token_delay * len(tokens)))
+                    return web.json_response({
+                        "id": f"chatcmpl-mock-{self.requests}",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": body.get("model", "mock"),
+                        "choices": [{
+                            "index": 0,
+                            "message": {"role": "assistant", "content": "".join(tokens)},
+                            "finish_reason": "length" if num_tokens == max_tokens else "stop",
+                        }],
+                        "usage": {
+                            "prompt_tokens": prompt_tokens,
+                            "completion_tokens": len(tokens),
+                            "total_tokens": prompt_tokens + len(tokens),
+                        },
+                    })
+
+                response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+                await response.prepare(request)
+                for token in tokens:
+                    chunk = {"choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+                    await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                    await asyncio.sleep(self.jittered(token_delay))
+                done = {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+                await response.write(f"data: {json.dumps(done)}\n\n".encode())
+                await response.write(b"data: [DONE]\n\n")
+                return response
+            finally:
+                self.active -= 1
+
+    async def models(self, request):
+        return web.json_response({"object": "list", "data": [{"id": "mock", "object": "model"}]})
+
+    async def stats(self, request):
+        return web.json_response({"requests": self.requests, "errors": self.errors, "active": self.active})
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible LM Studio server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1234)
+    parser.add_argument("--ttft", type=float, default=0.3, help="seconds until the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=40, help="decode speed per request")
+    parser.add_argument("--reply-tokens", type=int, default=40, help="length of each reply (capped by max_tokens)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with a 500")
+    parser.add_argument("--parallel", type=int, default=4, help="requests decoded at once, the rest wait")
+    parser.add_argument("--jitter", type=float, default=0.1, help="random +/- share applied to every delay")
+    args = parser.parse_args()
+
+    backend = MockBackend(args)
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", backend.chat_completions)
+    app.router.add_get("/v1/models", backend.models)
+    app.router.add_get("/mock/stats", backend.stats)
+    print(f"Mock LM Studio listening on http://{args.host}:{args.port}/v1/chat/completions")
+    web.run_app(app, host=args.host, port=args.port, print=None)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+"""Percentile helper shared by the bot, llm_benchmark.py and irc_simulator.py, so the
+latencies they report are comparable."""
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of a list of numbers, 0.0 when there are no samples"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
@@ -0,0 +1,21 @@
+import contextlib
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope="session")
+def cyrai(tmp_path_factory):
+    """The bot module, imported from a scratch directory so tests never touch the real
+    whitelist, system prompt, log file or stored conversations"""
+    workdir = tmp_path_factory.mktemp("cyrai")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        import cyrai
+    yield cyrai
+    os.chdir(cwd)
@@ -0,0 +1,28 @@
+URLS = ["http://127.0.0.1:1234/v1/chat/completions", "http://127.0.0.1:1235/v1/chat/completions"]
+
+
+def test_least_outstanding_spreads_load(cyrai):
+    pool = cyrai.BackendPool(URLS, strategy="least_outstanding")
+    first = pool.select()
+    first.start()
+    second = pool.select()
+    assert second is not first
+
+
+def test_latency_strategy_counts_unmeasured_backends_as_average(cyrai):
+    pool = cyrai.BackendPool(URLS, strategy="latency")
+    measured, fresh = pool.backends
+    measured.record_success(first_token=0.5)
+    # Unmeasured counts as 0.5 too, so load decides
+    fresh.start()
+    fresh.start()
+    assert pool.select() is measured
+
+
+def test_hedge_delay_uses_first_token_samples_only(cyrai):
+    pool = cyrai.BackendPool(URLS)
+    backend = pool.backends[0]
+    for _ in range(cyrai.LLM_HEDGE_MIN_SAMPLES):
+        backend.record_success(first_token=0.8)
+        backend.completion_latencies.append(20.0)
+    assert pool.hedge_delay() == 0.8
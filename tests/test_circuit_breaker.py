@@ -0,0 +1,72 @@
+URL = "http://127.0.0.1:1234/v1/chat/completions"
+
+
+def open_backend(cyrai):
+    backend = cyrai.LLMBackend(URL)
+    for _ in range(cyrai.LLM_CIRCUIT_FAILURE_THRESHOLD):
+        trial = backend.start()
+        backend.finish(trial)
+        backend.record_failure()
+    return backend
+
+
+def test_consecutive_failures_open_the_circuit(cyrai):
+    backend = cyrai.LLMBackend(URL)
+    for _ in range(cyrai.LLM_CIRCUIT_FAILURE_THRESHOLD - 1):
+        backend.record_failure()
+    assert backend.state == "closed"
+    backend.record_failure()
+    assert backend.state == "open"
+    assert not backend.available(backend.opened_at + 1)
+
+
+def test_open_half_open_trial_close(cyrai):
+    backend = open_backend(cyrai)
+    after_open_period = backend.opened_at + cyrai.LLM_CIRCUIT_OPEN_DURATION
+    assert backend.available(after_open_period)
+    assert backend.state == "half_open"
+    
+    # One trial at a time
+    assert backend.start() is True
+    assert not backend.available(after_open_period)
+    # A request from before the circuit opened finishing doesn't end the trial
+    backend.finish(False)
+    assert not backend.available(after_open_period)
+    
+    backend.finish(True)
+    backend.record_success(first_token=0.2)
+    assert backend.state == "closed"
+    assert backend.consecutive_errors == 0
+    assert backend.available(after_open_period)
+
+
+def test_failed_trial_reopens(cyrai):
+    backend = open_backend(cyrai)
+    backend.available(backend.opened_at + cyrai.LLM_CIRCUIT_OPEN_DURATION)
+    trial = backend.start()
+    backend.finish(trial)
+    backend.record_failure()
+    assert backend.state == "open"
+
+
+def test_health_probes(cyrai):
+    backend = cyrai.LLMBackend(URL)
+    # A single failed probe of a healthy backend isn't enough
+    backend.record_probe(False)
+    assert backend.state == "closed"
+    for _ in range(cyrai.LLM_CIRCUIT_FAILURE_THRESHOLD - 1):
+        backend.record_probe(False)
+    assert backend.state == "open"
+    # A good probe lets a trial through without waiting out the open period
+    backend.record_probe(True)
+    assert backend.state == "half_open"
+    assert backend.available(backend.opened_at)
+
+
+def test_pool_skips_open_backends(cyrai):
+    pool = cyrai.BackendPool([URL, "http://127.0.0.1:1235/v1/chat/completions"])
+    broken, healthy = pool.backends
+    for _ in range(cyrai.LLM_CIRCUIT_FAILURE_THRESHOLD):
+        broken.record_failure()
+    assert pool.select() is healthy
+    assert pool.select(exclude=[healthy]) is None
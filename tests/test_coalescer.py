@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+
+def test_identical_requests_share_one_job(cyrai):
+    async def scenario():
+        coalescer = cyrai.InflightCoalescer()
+        calls = []
+        
+        async def job():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "reply"
+        
+        results = await asyncio.gather(*(coalescer.run("key", job) for _ in range(3)))
+        return results, calls, coalescer.stats()
+    
+    results, calls, stats = asyncio.run(scenario())
+    assert results == [("reply", False), ("reply", True), ("reply", True)]
+    assert len(calls) == 1
+    assert stats == {"in_flight": 0, "leaders": 1, "coalesced": 2}
+
+
+def test_failure_reaches_every_waiter(cyrai):
+    async def scenario():
+        coalescer = cyrai.InflightCoalescer()
+        
+        async def job():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("backend down")
+        
+        results = await asyncio.gather(*(coalescer.run("key", job) for _ in range(3)), return_exceptions=True)
+        # The key is free again, the next request runs its own job
+        retry = await coalescer.run("key", lambda: asyncio.sleep(0, "recovered"))
+        return results, retry
+    
+    results, retry = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert retry == ("recovered", False)
+
+
+def test_cancelled_waiter_leaves_the_leader_running(cyrai):
+    async def scenario():
+        coalescer = cyrai.InflightCoalescer()
+        
+        async def job():
+            await asyncio.sleep(0.02)
+            return "reply"
+        
+        leader = asyncio.create_task(coalescer.run("key", job))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(coalescer.run("key", job))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return await leader
+    
+    assert asyncio.run(scenario()) == ("reply", False)
@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+
+class FakeBot:
+    """Just enough of TwitchBot for the queue: records what it sends, fails sends on request"""
+    
+    def __init__(self, failures=()):
+        self.sent = []
+        self.failures = list(failures)  # Texts whose next send raises ConnectionError
+    
+    def chat_ready(self):
+        return True
+    
+    def bot_is_mod(self, channel):
+        return True
+    
+    async def send_chat(self, channel, text):
+        if text in self.failures:
+            self.failures.remove(text)
+            raise ConnectionError("connection reset")
+        self.sent.append((channel, text))
+        return True
+
+
+def test_high_priority_lane_goes_first(cyrai):
+    async def scenario():
+        queue = cyrai.OutboundQueue()
+        bot = FakeBot()
+        futures = [
+            queue.put(bot, "chan", "normal one"),
+            queue.put(bot, "chan", "normal two"),
+            queue.put(bot, "chan", "mod reply", priority=cyrai.SEND_PRIORITY_HIGH),
+        ]
+        results = await asyncio.gather(*futures)
+        await queue.stop()
+        return results, bot.sent
+    
+    results, sent = asyncio.run(scenario())
+    assert results == [True, True, True]
+    assert [text for _, text in sent] == ["mod reply", "normal one", "normal two"]
+
+
+def test_retried_chunk_stays_ahead_of_its_channel(cyrai):
+    async def scenario():
+        queue = cyrai.OutboundQueue()
+        bot = FakeBot(failures=["chunk one"])
+        futures = [
+            queue.put(bot, "chan", "chunk one"),
+            queue.put(bot, "chan", "chunk two"),
+            queue.put(bot, "other", "elsewhere"),
+        ]
+        results = await asyncio.wait_for(asyncio.gather(*futures), 5)
+        stats = queue.stats()
+        await queue.stop()
+        return results, bot.sent, stats
+    
+    results, sent, stats = asyncio.run(scenario())
+    assert results == [True, True, True]
+    # The other channel isn't held up by the retry, this one keeps its order
+    assert sent == [("other", "elsewhere"), ("chan", "chunk one"), ("chan", "chunk two")]
+    assert stats["retried"] == 1
+
+
+def test_stale_messages_are_dropped(cyrai):
+    async def scenario():
+        queue = cyrai.OutboundQueue()
+        bot = FakeBot()
+        stale = queue.put(bot, "chan", "too late", deadline=time.perf_counter() - 1)
+        fresh = queue.put(bot, "chan", "in time", deadline=time.perf_counter() + 60)
+        results = await asyncio.gather(stale, fresh)
+        stats = queue.stats()
+        await queue.stop()
+        return results, bot.sent, stats
+    
+    results, sent, stats = asyncio.run(scenario())
+    assert results == [False, True]
+    assert sent == [("chan", "in time")]
+    assert stats["dropped_stale"] == 1
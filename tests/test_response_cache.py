@@ -0,0 +1,35 @@
+def test_entries_expire_after_ttl(cyrai, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cyrai.time, "monotonic", lambda: now[0])
+    cache = cyrai.ResponseCache(max_entries=10, max_chars=10000, ttl=60)
+    cache.put("key", "reply")
+    now[0] += 59
+    assert cache.get("key") == "reply"
+    now[0] += 2
+    assert cache.get("key") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_entry_is_evicted(cyrai):
+    cache = cyrai.ResponseCache(max_entries=2, max_chars=10000, ttl=60)
+    cache.put("a", "reply a")
+    cache.put("b", "reply b")
+    # Reading a makes b the least recently used
+    assert cache.get("a") == "reply a"
+    cache.put("c", "reply c")
+    assert cache.get("b") is None
+    assert cache.get("a") == "reply a"
+    assert cache.get("c") == "reply c"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_character_budget_evicts_and_skips_oversized(cyrai):
+    cache = cyrai.ResponseCache(max_entries=10, max_chars=20, ttl=60)
+    cache.put("a", "x" * 10)
+    cache.put("b", "y" * 10)
+    # Key plus reply is 11 characters each, the pair doesn't fit in 20
+    assert cache.get("a") is None
+    assert cache.stats()["chars"] == 11
+    cache.put("c", "z" * 30)
+    assert cache.get("c") is None
+    assert cache.get("b") == "y" * 10
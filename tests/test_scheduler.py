@@ -0,0 +1,120 @@
+import asyncio
+
+
+def test_slots_go_round_robin_across_users(cyrai):
+    async def scenario():
+        scheduler = cyrai.LLMScheduler(max_concurrency=1, batch_window=0)
+        release = asyncio.Event()
+        order = []
+        
+        def job(name):
+            async def run():
+                order.append(name)
+                if name == "first":
+                    await release.wait()
+            return run
+        
+        tasks = [asyncio.create_task(scheduler.run("alice", job("first")))]
+        await asyncio.sleep(0)
+        # alice floods the queue before bob and carol ask once each
+        for i in range(3):
+            tasks.append(asyncio.create_task(scheduler.run("alice", job(f"alice{i}"))))
+        tasks.append(asyncio.create_task(scheduler.run("bob", job("bob"))))
+        tasks.append(asyncio.create_task(scheduler.run("carol", job("carol"))))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(*tasks)
+        return order
+    
+    assert asyncio.run(scenario()) == ["first", "alice0", "bob", "carol", "alice1", "alice2"]
+
+
+def test_background_jobs_wait_for_chat(cyrai):
+    async def scenario():
+        scheduler = cyrai.LLMScheduler(max_concurrency=1, batch_window=0)
+        release = asyncio.Event()
+        order = []
+        
+        async def blocker():
+            await release.wait()
+        
+        def job(name):
+            async def run():
+                order.append(name)
+            return run
+        
+        tasks = [asyncio.create_task(scheduler.run("alice", blocker))]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(scheduler.run("summary", job("summary"), background=True)))
+        tasks.append(asyncio.create_task(scheduler.run("bob", job("bob"))))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(*tasks)
+        return order
+    
+    assert asyncio.run(scenario()) == ["bob", "summary"]
+
+
+def test_per_user_queue_limit_rejects(cyrai):
+    async def scenario():
+        scheduler = cyrai.LLMScheduler(max_concurrency=1, max_queue_per_user=1, batch_window=0)
+        release = asyncio.Event()
+        
+        async def blocker():
+            await release.wait()
+        
+        running = asyncio.create_task(scheduler.run("alice", blocker))
+        queued = asyncio.create_task(scheduler.run("alice", blocker))
+        await asyncio.sleep(0)
+        try:
+            await scheduler.run("alice", blocker)
+        except cyrai.LLMQueueFullError:
+            rejected = True
+        else:
+            rejected = False
+        release.set()
+        await asyncio.gather(running, queued)
+        return rejected, scheduler.stats()["rejected"]
+    
+    assert asyncio.run(scenario()) == (True, 1)
+
+
+def test_batch_waits_for_the_window(cyrai):
+    async def scenario():
+        scheduler = cyrai.LLMScheduler(max_concurrency=4, batch_window=0.05, batch_max_size=4)
+        started = []
+        
+        def job(name):
+            async def run():
+                started.append(name)
+            return run
+        
+        tasks = [asyncio.create_task(scheduler.run(name, job(name))) for name in ("alice", "bob")]
+        await asyncio.sleep(0.01)
+        held = list(started)
+        await asyncio.gather(*tasks)
+        return held, started, scheduler.stats()["batching"]
+    
+    held, started, batching = asyncio.run(scenario())
+    assert held == []
+    assert sorted(started) == ["alice", "bob"]
+    assert batching["batches"] == 1
+    assert batching["avg_batch_size"] == 2
+
+
+def test_full_batch_goes_without_waiting(cyrai):
+    async def scenario():
+        scheduler = cyrai.LLMScheduler(max_concurrency=3, batch_window=10, batch_max_size=8)
+        names = ["alice", "bob", "carol"]
+        
+        async def job():
+            pass
+        
+        # The window is far too long to be waited out; a full batch (capped by max_concurrency) mustn't wait
+        await asyncio.wait_for(asyncio.gather(*(scheduler.run(name, job) for name in names)), 1)
+        return scheduler.stats()["batching"]
+    
+    batching = asyncio.run(scenario())
+    assert batching["effective_size"] == 3
+    assert batching["batches"] == 1
+    assert batching["occupancy"] == 1.0